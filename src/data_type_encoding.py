@@ -1,4 +1,6 @@
 from typing import Union, Tuple
+import math
+import struct
 import numpy as np
 
 from encoding import EncodingSettings, EncodingError, DecodingError
@@ -8,17 +10,22 @@ EncodableNumber = Union[int, float, np.ndarray]
 
 class NoNumberEncoding(Exception):
     def __init__(self, msg):
-        super.__init__(msg)
+        super().__init__(msg)
 
 
 def encode_numeric(number: EncodableNumber):
     """ Encode numeric data """
     if isinstance(number, int):
-        return encode_numeric(np.array(number, dtype=EncodingSettings.int_dtype))
+        return _encode_scalar(number, 0, _signed_struct_codes[EncodingSettings.int_bytes])
     elif isinstance(number, float):
-        return encode_numeric(np.array(number, dtype=EncodingSettings.float_dtype))
+        return _encode_scalar(number, 1, _float_struct_codes[EncodingSettings.float_bytes])
     elif isinstance(number, np.ndarray):
         return _encode_numpy_array(number)
+    elif isinstance(number, np.integer):
+        # numpy scalars (apart from float64, which is a float) are encoded as python numbers of the same kind
+        return _encode_scalar(int(number), 0, _signed_struct_codes[EncodingSettings.int_bytes])
+    elif isinstance(number, np.floating):
+        return _encode_scalar(float(number), 1, _float_struct_codes[EncodingSettings.float_bytes])
     else:
         raise NoNumberEncoding(f"Cannot encode numbers of type {type(number)}")
 
@@ -27,6 +34,78 @@ def _encode_int(x: int):
     return x.to_bytes(EncodingSettings.int_bytes, EncodingSettings.endianness)
 
 
+# struct codes for numbers of each size (in bytes)
+_unsigned_struct_codes = {1: "B", 2: "H", 4: "I", 8: "Q"}
+_signed_struct_codes = {1: "b", 2: "h", 4: "i", 8: "q"}
+_float_struct_codes = {2: "e", 4: "f", 8: "d"}
+
+
+def _byte_order() -> str:
+    """ Byte order character (as used by struct and numpy) for EncodingSettings.endianness"""
+    return ">" if EncodingSettings.endianness == "big" else "<"
+
+
+def _encoded_dtype(dtype) -> np.dtype:
+    """ Version of a dtype with the byte order used in encoded data"""
+    return np.dtype(dtype).newbyteorder(_byte_order())
+
+
+def _numeric_header_format(shape_length: int) -> str:
+    """ struct format for the type byte (and item size byte, see _encode_numpy_array) and shape
+    of encoded numeric data, only valid if there is a struct code for the dimension encoding depth"""
+    byte_order = _byte_order()
+    item_size_code = "B" if EncodingSettings.allow_narrow_precision else ""
+    dimension_code = _unsigned_struct_codes[EncodingSettings.dimension_encoding_depth]
+    return f"{byte_order}B{item_size_code}{shape_length}{dimension_code}"
+
+
+# Smaller types that arrays can be stored as, with EncodingSettings.allow_narrow_precision
+_narrow_int_dtypes = (np.dtype(np.int8), np.dtype(np.int16), np.dtype(np.int32))
+_narrow_float_dtypes = (np.dtype(np.float16), np.dtype(np.float32))
+
+
+def _narrowest_dtype(arr: np.ndarray) -> np.dtype:
+    """ Smallest type of the same kind as `arr` that holds all its values exactly"""
+    if arr.dtype.kind == "i":
+        if arr.size == 0:
+            return _narrow_int_dtypes[0]
+
+        low, high = arr.min(), arr.max()
+        for dtype in _narrow_int_dtypes:
+            if dtype.itemsize >= arr.dtype.itemsize:
+                break
+
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return dtype
+
+    else:
+        for dtype in _narrow_float_dtypes:
+            if dtype.itemsize >= arr.dtype.itemsize:
+                break
+
+            # Values too big for the smaller type become inf, and so don't compare equal
+            with np.errstate(over="ignore"):
+                narrowed = arr.astype(dtype)
+
+            if np.array_equal(narrowed.astype(arr.dtype), arr, equal_nan=True):
+                return dtype
+
+    return arr.dtype
+
+
+def _encode_scalar(number: Union[int, float], int_float_flag: int, code: str) -> bytes:
+    """ Encode a python int or float, this is the same as encoding a 0-dimensional array,
+    i.e. a type byte (just the int/float flag) followed by the value, but without going via numpy"""
+    try:
+        if EncodingSettings.allow_narrow_precision:
+            # Scalars are always stored at full size
+            return struct.pack(f"{_byte_order()}BB{code}", int_float_flag, struct.calcsize(code), number)
+        else:
+            return struct.pack(f"{_byte_order()}B{code}", int_float_flag, number)
+    except (struct.error, OverflowError):
+        raise EncodingError(f"Number out of range for encoding: {number}")
+
 
 def _encode_numpy_array(arr: np.ndarray):
     """ Main part of encoding numeric data
@@ -34,34 +113,61 @@ def _encode_numpy_array(arr: np.ndarray):
     [      0    |   1234567    ] [4 bytes x (shape length)] [ data length ]
     [ int/float | shape length ] [         shape          ] [    data     ]
 
+    With EncodingSettings.allow_narrow_precision, the type byte is followed by a byte giving the
+    size of each value, and the data is stored in the smallest type that holds it exactly
+
+    [      0    |   1234567    ] [  1 byte   ] [4 bytes x (shape length)] [ data length ]
+    [ int/float | shape length ] [ item size ] [         shape          ] [    data     ]
+
     """
 
-    # Is it an int array or a float array
+    # Is it an int array or a float array, convert to the encoded type and byte order,
+    # only copying if the type, byte order or layout needs changing
     if arr.dtype.kind == "i":
         int_float_flag = 0
-        arr = arr.astype(EncodingSettings.int_dtype)
+        arr = arr.astype(_encoded_dtype(EncodingSettings.int_dtype), order="C", copy=False)
     elif arr.dtype.kind == "f":
         int_float_flag = 1
-        arr = arr.astype(EncodingSettings.float_dtype)
+        arr = arr.astype(_encoded_dtype(EncodingSettings.float_dtype), order="C", copy=False)
     else:
         raise NoNumberEncoding(f"Cannot encode data of dtype {arr.dtype}")
 
+    narrow = EncodingSettings.allow_narrow_precision
+    if narrow:
+        arr = arr.astype(_encoded_dtype(_narrowest_dtype(arr)), copy=False)
+        item_size = (arr.dtype.itemsize, )
+    else:
+        item_size = ()
+
     # Get length of shape
     shape_length = len(arr.shape)
     if shape_length > 127:
         raise EncodingError(f"To many dimensions in array ({shape_length})")
 
-    type_byte = (2*shape_length + int_float_flag).to_bytes(1, EncodingSettings.endianness, signed=False)
-    shape_bytes = [x.to_bytes(
-                    EncodingSettings.dimension_encoding_depth,
-                    EncodingSettings.endianness,
-                    signed=False) for x in arr.shape]
+    type_value = (shape_length << 1) | int_float_flag
 
-    data_bytes = arr.tobytes()
+    depth = EncodingSettings.dimension_encoding_depth
 
-    sections = [type_byte] + shape_bytes + [data_bytes]
+    if depth in _unsigned_struct_codes:
+        # Pack type byte and shape in one go
+        header = struct.pack(
+            _numeric_header_format(shape_length),
+            type_value,
+            *item_size,
+            *arr.shape)
 
-    return b''.join(sections)
+    else:
+        # Single byte, so no need to worry about endianness
+        type_byte = bytes((type_value,) + item_size)
+        endianness = EncodingSettings.endianness
+        shape_bytes = [x.to_bytes(depth, endianness, signed=False) for x in arr.shape]
+
+        header = b''.join([type_byte] + shape_bytes)
+
+    # Use the array's buffer directly, rather than a tobytes() copy, so the data is only copied once by join
+    data_bytes = memoryview(arr)
+
+    return b''.join((header, data_bytes))
 
 
 def decode_numeric(data: bytes):
@@ -76,41 +182,62 @@ def decode_numeric_with_size(data: bytes):
     :return: (decoded, read_size) the decoded data along with the number of bytes read
     """
 
+    depth = EncodingSettings.dimension_encoding_depth
+
     # Get the type and shape
-    int_float_flag = data[0] & 1
-    dtype = EncodingSettings.int_dtype if int_float_flag == 0 else EncodingSettings.float_dtype
-    dsize = EncodingSettings.int_bytes if int_float_flag == 0 else EncodingSettings.float_bytes
+    type_value = data[0]
+    int_float_flag = type_value & 1
+    if int_float_flag == 0:
+        dtype = EncodingSettings.int_dtype
+        dsize = EncodingSettings.int_bytes
+    else:
+        dtype = EncodingSettings.float_dtype
+        dsize = EncodingSettings.float_bytes
 
-    shape_length = data[0] >> 1
+    shape_length = type_value >> 1
 
-    shape = []
-    for i in range(shape_length):
-        a = EncodingSettings.dimension_encoding_depth*i + 1
-        b = a + EncodingSettings.dimension_encoding_depth
-        dim_data = data[a:b]
-        dim = int.from_bytes(dim_data, EncodingSettings.endianness, signed=False)
-        shape.append(dim)
+    # Values might be stored in a smaller type than they are decoded to
+    if EncodingSettings.allow_narrow_precision:
+        shape_start = 2
+        dsize = data[1]
+        stored_dtype = np.dtype(f"{'i' if int_float_flag == 0 else 'f'}{dsize}")
+    else:
+        shape_start = 1
+        stored_dtype = dtype
 
-    n_datapoints = 1
-    for n in shape:
-        n_datapoints *= n
+    if depth in _unsigned_struct_codes:
+        # Read all dimensions in one go
+        shape = struct.unpack_from(_numeric_header_format(shape_length), data)[shape_start:]
 
-    data_start = 1 + shape_length*EncodingSettings.dimension_encoding_depth
+    else:
+        endianness = EncodingSettings.endianness
+        shape = []
+        for i in range(shape_length):
+            a = depth*i + shape_start
+            b = a + depth
+            dim_data = data[a:b]
+            dim = int.from_bytes(dim_data, endianness, signed=False)
+            shape.append(dim)
+
+    n_datapoints = math.prod(shape)
+
+    data_start = shape_start + shape_length*depth
     data_end = data_start + dsize*n_datapoints
 
     data_bytes = data[data_start:data_end]
 
-    unshaped = np.frombuffer(data_bytes, dtype=dtype)
+    # Data is in the encoding byte order, convert to the native one (no copy if they are the same)
+    unshaped = np.frombuffer(data_bytes, dtype=_encoded_dtype(stored_dtype)).astype(dtype, copy=False)
 
     if len(shape) == 0:
         # Return a python, not numpy object
 
         if int_float_flag == 0:
             # integer
-            return int(unshaped), data_end
+            return int(unshaped[0]), data_end
         else:
             # float
-            return float(unshaped), data_end
+            return float(unshaped[0]), data_end
 
     else:
         return unshaped.reshape(tuple(shape)), data_end
@@ -119,8 +246,9 @@ def decode_numeric_with_size(data: bytes):
 def encode_bytestring(data: bytes) -> bytes:
     """ Encode data bytes"""
     n = len(data)
-    if n > EncodingSettings.bytestring_length_max:
-        raise EncodingError(f"Data too long to encode (length={n}, limit={EncodingSettings.bytestring_length_max})")
+    length_max = EncodingSettings.bytestring_length_max
+    if n > length_max:
+        raise EncodingError(f"Data too long to encode (length={n}, limit={length_max})")
 
     return n.to_bytes(
         EncodingSettings.bytestring_length_bytes,
@@ -133,16 +261,18 @@ def decode_bytestring_with_size(data: bytes) -> Tuple[bytes, int]:
         encoded in the data, not at the end of the data string,
         returns the byte string along with the end of encoded string"""
 
-    if len(data) < EncodingSettings.bytestring_length_bytes:
-        raise DecodingError(f"Encoded bytestring too short (smaller than length specifier length, {EncodingSettings.bytestring_length_bytes} bytes)")
+    length_bytes = EncodingSettings.bytestring_length_bytes
+
+    if len(data) < length_bytes:
+        raise DecodingError(f"Encoded bytestring too short (smaller than length specifier length, {length_bytes} bytes)")
 
     data_length = int.from_bytes(
-        data[:EncodingSettings.bytestring_length_bytes],
+        data[:length_bytes],
         EncodingSettings.endianness,
         signed=False)
 
-    length = data_length + EncodingSettings.bytestring_length_bytes
-    out = data[EncodingSettings.bytestring_length_bytes:length]
+    length = data_length + length_bytes
+    out = data[length_bytes:length]
 
     return out, length
 
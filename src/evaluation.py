@@ -0,0 +1,471 @@
+""" Flat evaluation of expressions
+
+Calling an expression directly walks the tree, paying for a python call at every node.
+Here, an expression is instead linearised (post-order, shared nodes visited once) into a list of
+instructions, each of which reads from and writes to numbered slots, and which can then be run
+in a simple loop.
+
+Instructions are tuples of the form (opcode, out_slot, in_a, in_b), for CONST and VAR the first
+input is an index into the constant and variable lists, for unary operations the second input is
+unused (-1), and n-ary operations (Sum and Product) become a chain of binary ones
+
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+import math
+import operator
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import expression as expr
+from expression import Expression, EvaluationError
+
+# Opcodes
+
+ADD = 0
+SUB = 1
+MUL = 2
+DIV = 3
+NEG = 4
+POW = 5
+EXP = 6
+LOG = 7
+ABS = 8
+SIGN = 9
+CONST = 10
+VAR = 11
+MOD = 12
+COS = 13
+SIN = 14
+
+_opcodes = {
+    expr.Plus: ADD,
+    expr.Minus: SUB,
+    expr.Times: MUL,
+    expr.Divide: DIV,
+    expr.Neg: NEG,
+    expr.Power: POW,
+    expr.Exp: EXP,
+    expr.Log: LOG,
+    expr.Abs: ABS,
+    expr.Sign: SIGN,
+    expr.Constant: CONST,
+    expr.Variable: VAR,
+    expr.Modulo: MOD,
+    expr.Cos: COS,
+    expr.Sin: SIN,
+    expr.Sum: ADD,
+    expr.Product: MUL,
+}
+
+# Operation for each opcode, these are the same as the `apply` methods of the expression classes,
+# so results match those from calling the expression tree, CONST and VAR are handled separately
+
+_operations = (
+    operator.add,
+    operator.sub,
+    operator.mul,
+    operator.truediv,
+    operator.neg,
+    operator.pow,
+    np.exp,
+    np.log,
+    abs,
+    np.sign,
+    None,
+    None,
+    operator.mod,
+    np.cos,
+    np.sin,
+)
+
+# ufuncs for each opcode, used when evaluating arrays so that results can be written into existing buffers
+
+_ufuncs = (
+    np.add,
+    np.subtract,
+    np.multiply,
+    np.true_divide,
+    np.negative,
+    np.power,
+    np.exp,
+    np.log,
+    np.absolute,
+    np.sign,
+    None,
+    None,
+    np.remainder,
+    np.cos,
+    np.sin,
+)
+
+# Source code for each opcode, used for generating numba functions, {0} and {1} are the inputs
+
+_source_templates = (
+    "{0} + {1}",
+    "{0} - {1}",
+    "{0} * {1}",
+    "{0} / {1}",
+    "-{0}",
+    "{0} ** {1}",
+    "np.exp({0})",
+    "np.log({0})",
+    "np.abs({0})",
+    "np.sign({0})",
+    None,
+    None,
+    "{0} % {1}",
+    "np.cos({0})",
+    "np.sin({0})",
+)
+
+# Source for elementwise functions, where the inputs are single numbers, for which the math
+# functions are cheaper (in numba) than the numpy ufuncs
+
+_elementwise_source_templates = (
+    "{0} + {1}",
+    "{0} - {1}",
+    "{0} * {1}",
+    "{0} / {1}",
+    "-{0}",
+    "{0} ** {1}",
+    "math.exp({0})",
+    "math.log({0})",
+    "abs({0})",
+    "np.sign({0})",
+    None,
+    None,
+    "{0} % {1}",
+    "math.cos({0})",
+    "math.sin({0})",
+)
+
+Instruction = Tuple[int, int, int, int]
+
+
+def _cast(value: Any, dtype: Optional[np.dtype]) -> Any:
+    """ Convert a number or array to the given dtype (no copy if it is already of that dtype)"""
+    if dtype is None:
+        return value
+    elif isinstance(value, np.ndarray):
+        return value.astype(dtype, copy=False)
+    else:
+        return dtype.type(value)
+
+
+class CompiledExpression:
+    """ An expression flattened into a list of instructions, if `dtype` is given, the
+    inputs (and constants) are converted to it, so that all of the evaluation is done in that type"""
+
+    def __init__(self,
+                 instructions: List[Instruction],
+                 constants: List[Any],
+                 variables: List[bytes],
+                 n_slots: int,
+                 dtype: Optional[np.dtype] = None):
+
+        self.instructions = instructions
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.constants = [_cast(constant, self.dtype) for constant in constants]
+        self.variables = variables
+        self.n_slots = n_slots
+
+        self._function: Optional[CompiledFunction] = None
+        self._jitted: Dict[Tuple[bool, bool], CompiledFunction] = {}
+        self._with_dtype: Dict[np.dtype, CompiledExpression] = {}
+
+        # Slots that are read for the last time by each instruction, the arrays in them
+        # can be reused once that instruction has its inputs
+        last_use: Dict[int, int] = {}
+        for index, (opcode, out_slot, in_a, in_b) in enumerate(instructions):
+            if opcode != CONST and opcode != VAR:
+                last_use[in_a] = index
+                if in_b >= 0:
+                    last_use[in_b] = index
+
+        self._released: List[List[int]] = [[] for _ in instructions]
+        for slot, index in last_use.items():
+            self._released[index].append(slot)
+
+    def with_dtype(self, dtype) -> CompiledExpression:
+        """ Version of this that evaluates in a given dtype, e.g. np.float32, which moves half as
+        much data as float64 for large arrays, at the cost of precision"""
+        dtype = np.dtype(dtype)
+        if dtype == self.dtype:
+            return self
+
+        if dtype not in self._with_dtype:
+            self._with_dtype[dtype] = CompiledExpression(
+                self.instructions, self.constants, self.variables, self.n_slots, dtype)
+
+        return self._with_dtype[dtype]
+
+    def __call__(self, variable_map: Dict[bytes, Any]):
+
+        if self.dtype is not None:
+            variable_map = {variable: _cast(variable_map[variable], self.dtype) for variable in self.variables}
+
+        for variable in self.variables:
+            if isinstance(variable_map[variable], np.ndarray):
+                return self._call_arrays(variable_map)
+
+        slots: List[Any] = [None] * self.n_slots
+
+        constants = self.constants
+        variables = self.variables
+
+        for opcode, out_slot, in_a, in_b in self.instructions:
+            if opcode == CONST:
+                slots[out_slot] = constants[in_a]
+            elif opcode == VAR:
+                slots[out_slot] = variable_map[variables[in_a]]
+            elif in_b < 0:
+                slots[out_slot] = _operations[opcode](slots[in_a])
+            else:
+                slots[out_slot] = _operations[opcode](slots[in_a], slots[in_b])
+
+        return slots[self.n_slots - 1]
+
+    def _call_arrays(self, variable_map: Dict[bytes, Any]):
+        """ Evaluation when there are array inputs. Rather than allocating a new array for every
+        operation, float results are written into arrays from earlier operations that are no
+        longer needed (a linear scan over the instructions, with the last use of each slot
+        known in advance)"""
+
+        slots: List[Any] = [None] * self.n_slots
+
+        # Whether a slot holds an array made here (not an input or constant), which can be overwritten
+        owned: List[bool] = [False] * self.n_slots
+
+        # Arrays that can be overwritten, by shape and dtype
+        free: Dict[Tuple[Tuple[int, ...], np.dtype], List[np.ndarray]] = {}
+
+        constants = self.constants
+        variables = self.variables
+        released = self._released
+
+        for index, (opcode, out_slot, in_a, in_b) in enumerate(self.instructions):
+            if opcode == CONST:
+                slots[out_slot] = constants[in_a]
+                continue
+            elif opcode == VAR:
+                slots[out_slot] = variable_map[variables[in_a]]
+                continue
+
+            inputs = (slots[in_a], ) if in_b < 0 else (slots[in_a], slots[in_b])
+
+            for slot in released[index]:
+                if owned[slot]:
+                    owned[slot] = False
+                    array = slots[slot]
+                    free.setdefault((array.shape, array.dtype), []).append(array)
+
+            # Only reuse arrays for float results, all the operations give a result of the
+            # same dtype as their (float) inputs, so it is known in advance
+            out = None
+            dtype = np.result_type(*inputs)
+            if dtype.kind == "f":
+                buffers = free.get((np.broadcast_shapes(*[np.shape(x) for x in inputs]), dtype))
+                if buffers:
+                    out = buffers.pop()
+
+            if out is None:
+                result = _operations[opcode](*inputs)
+            else:
+                result = _ufuncs[opcode](*inputs, out=out)
+
+            slots[out_slot] = result
+            owned[out_slot] = isinstance(result, np.ndarray)
+
+        return slots[self.n_slots - 1]
+
+    def source(self, function_name: str = "evaluate", elementwise: bool = False) -> str:
+        """ Python source for a function evaluating the instructions in straight-line form,
+        arguments are the variables in the order given by `self.variables`,
+        constants are referred to as globals c0, c1, ...
+
+        If `elementwise` is set, the arguments are 1D arrays of the same length, followed by an
+        output array, and the instructions are evaluated in a loop over their elements (`prange`),
+        rather than on the whole arrays"""
+
+        arguments = [f"x{i}" for i in range(len(self.variables))]
+
+        if elementwise:
+            lines = [f"def {function_name}({', '.join(arguments + ['out'])}):",
+                     f"    for i in prange(out.shape[0]):"]
+            indent = "        "
+            index = "[i]"
+            templates = _elementwise_source_templates
+        else:
+            lines = [f"def {function_name}({', '.join(arguments)}):"]
+            indent = "    "
+            index = ""
+            templates = _source_templates
+
+        for opcode, out_slot, in_a, in_b in self.instructions:
+            if opcode == CONST:
+                value = f"c{in_a}"
+            elif opcode == VAR:
+                value = f"x{in_a}{index}"
+            else:
+                value = templates[opcode].format(f"t{in_a}", f"t{in_b}")
+
+            lines.append(f"{indent}t{out_slot} = {value}")
+
+        if elementwise:
+            lines.append(f"{indent}out[i] = t{self.n_slots - 1}")
+        else:
+            lines.append(f"{indent}return t{self.n_slots - 1}")
+
+        return "\n".join(lines)
+
+    def _define(self, elementwise: bool = False) -> Callable:
+        """ Define the function given by `source`, with the constants it refers to"""
+        namespace = {"np": np, "math": math, "prange": range if numba is None else numba.prange}
+        namespace.update({f"c{i}": value for i, value in enumerate(self.constants)})
+
+        exec(self.source(elementwise=elementwise), namespace)
+
+        return namespace["evaluate"]
+
+    def function(self) -> CompiledFunction:
+        """ The instructions as a single python function (see `source`), so that evaluating
+        is one python call, rather than one per instruction"""
+
+        if self._function is None:
+            self._function = CompiledFunction(self._define(), self.variables, self.dtype)
+
+        return self._function
+
+    def jit(self, fastmath: bool = False, parallel: bool = False) -> CompiledFunction:
+        """ Compile to native code with numba, the compiled function is kept, so this is
+        only done once for each value of `fastmath` (which allows numba to assume there are
+        no nans or infs, among other things) and `parallel`.
+
+        With `parallel`, the whole expression is evaluated for each element in turn, in a loop
+        that numba spreads over threads, so there are no intermediate arrays. The inputs are
+        broadcast together, and array constants are not allowed"""
+
+        key = (fastmath, parallel)
+        if key not in self._jitted:
+            if numba is None:
+                raise EvaluationError("numba is required for jit compilation")
+
+            if parallel:
+                for constant in self.constants:
+                    if isinstance(constant, np.ndarray):
+                        raise EvaluationError("Cannot evaluate array constants elementwise")
+
+                kernel = numba.njit(fastmath=fastmath, parallel=True)(self._define(elementwise=True))
+
+                self._jitted[key] = ElementwiseCompiledFunction(kernel, self.variables, self.dtype)
+
+            else:
+                kernel = numba.njit(fastmath=fastmath)(self._define())
+
+                self._jitted[key] = CompiledFunction(kernel, self.variables, self.dtype)
+
+        return self._jitted[key]
+
+
+class CompiledFunction:
+    """ A generated function (plain python, or compiled by numba) called with a variable map in
+    the same way as an Expression, the function itself is `kernel`, which takes the variables positionally"""
+
+    def __init__(self, kernel: Callable, variables: List[bytes], dtype: Optional[np.dtype] = None):
+        self.kernel = kernel
+        self.variables = variables
+        self.dtype = dtype
+
+    def __call__(self, variable_map: Dict[bytes, Any]):
+        return self.kernel(*[_cast(variable_map[variable], self.dtype) for variable in self.variables])
+
+
+class ElementwiseCompiledFunction(CompiledFunction):
+    """ A CompiledFunction for kernels generated with `elementwise` (see CompiledExpression.source),
+    which take flat arrays of equal length and an output array"""
+
+    def __call__(self, variable_map: Dict[bytes, Any]):
+        values = [_cast(variable_map[variable], self.dtype) for variable in self.variables]
+
+        shape = np.broadcast_shapes(*[np.shape(value) for value in values])
+        arrays = [np.ascontiguousarray(np.broadcast_to(value, shape)).reshape(-1) for value in values]
+
+        dtype = np.float64 if self.dtype is None else self.dtype
+        out = np.empty(int(np.prod(shape, dtype=np.int64)), dtype=dtype)
+
+        self.kernel(*arrays, out)
+
+        return out.reshape(shape)
+
+
+def compile_expression(expression: Expression) -> CompiledExpression:
+    """ Linearise an expression into a CompiledExpression, the result is in the last slot"""
+
+    instructions: List[Instruction] = []
+    constants: List[Any] = []
+    variables: List[bytes] = []
+    variable_indices: Dict[bytes, int] = {}
+
+    # Slot for each node that has been emitted, nodes are interned, so key on id
+    slots: Dict[int, int] = {}
+    n_slots = 0
+
+    # Iterative post-order traversal, entries are (node, children_done)
+    stack: List[Tuple[Expression, bool]] = [(expression, False)]
+    while stack:
+        node, children_done = stack.pop()
+
+        if id(node) in slots:
+            continue
+
+        if not children_done:
+            stack.append((node, True))
+            for term in reversed(node.terms):
+                stack.append((term, False))
+            continue
+
+        try:
+            opcode = _opcodes[node.__class__]
+        except KeyError:
+            raise EvaluationError(f"Cannot compile expressions containing {node.__class__.__name__}")
+
+        if opcode == CONST:
+            instructions.append((CONST, n_slots, len(constants), -1))
+            constants.append(node.value)
+
+        elif opcode == VAR:
+            if node.identity not in variable_indices:
+                variable_indices[node.identity] = len(variables)
+                variables.append(node.identity)
+
+            instructions.append((VAR, n_slots, variable_indices[node.identity], -1))
+
+        else:
+            terms = node.terms
+            in_a = slots[id(terms[0])]
+
+            if len(terms) == 1:
+                instructions.append((opcode, n_slots, in_a, -1))
+
+            else:
+                # Intermediate results of n-ary operations get their own slots
+                for term in terms[1:-1]:
+                    instructions.append((opcode, n_slots, in_a, slots[id(term)]))
+                    in_a = n_slots
+                    n_slots += 1
+
+                instructions.append((opcode, n_slots, in_a, slots[id(terms[-1])]))
+
+        slots[id(node)] = n_slots
+        n_slots += 1
+
+    return CompiledExpression(instructions, constants, variables, n_slots)
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
-from typing import Dict, Any, Optional, Callable, List, Set, Tuple, Type, Union
+from typing import Dict, Any, Optional, Callable, FrozenSet, Iterator, List, Tuple, Type, Union
 
 from fractions import Fraction
 from collections import defaultdict
+from functools import reduce
+from weakref import WeakValueDictionary
 from encoding import EncodingSettings, EncodingError, DecodingError
 from data_type_encoding import (
     EncodableNumber,
@@ -12,10 +14,23 @@ from data_type_encoding import (
 
 import numpy as np
 
+import math
 import logging
 
 logger = logging.getLogger("expressions")
 
+# Every node is interned here, so building a structurally identical expression
+# returns the node that already exists, making trees into DAGs with shared subtrees.
+# Keys for compound nodes contain the ids of their (interned) children, which stay
+# alive for as long as the node referencing them does
+_intern_cache: WeakValueDictionary = WeakValueDictionary()
+
+# Marks a missing entry in Expression._matches, where None means "doesn't match"
+_no_match_data = object()
+
+# wildcard_numbers of expressions without wildcards
+_no_wildcards: FrozenSet[int] = frozenset()
+
 
 #
 # Errors
@@ -31,7 +46,7 @@ class NonDifferentiableExpressionError(Exception):
 class NoEncodingEntry(Exception):
     """ No encoding exists for class """
     def __init__(self, msg):
-        super.__init__(msg)
+        super().__init__(msg)
 
 
 class EvaluationError(Exception):
@@ -47,10 +62,20 @@ class SubstitutionError(Exception):
 
 
 class MatchFailure(Exception):
-    """ Exception used to signal that a pattern does not match"""
+    """ Exception used to signal that a pattern does not match (matching itself
+    signals this by returning None, see Expression.match). The message is only
+    made when it is needed, as it includes the string forms of both expressions"""
     def __init__(self, pattern, expression):
-        self.msg = f"{pattern} does not match {expression}"
-        super().__init__(self.msg)
+        super().__init__(pattern, expression)
+        self.pattern = pattern
+        self.expression = expression
+
+    @property
+    def msg(self):
+        return f"{self.pattern} does not match {self.expression}"
+
+    def __str__(self):
+        return self.msg
 
 
 class MatchError(Exception):
@@ -61,6 +86,42 @@ class MatchError(Exception):
 
 class Expression:
 
+    # Expressions are immutable and created in large numbers, so don't give them a __dict__,
+    # __weakref__ is needed for the intern cache. As they are immutable, results of
+    # differentiation, simplification, constant reduction and matching can be kept on the node
+    __slots__ = ('__weakref__', '_compiled', '_derivatives', '_simplified', '_reduced', '_matches', '_head_mask',
+                 '_match_program', '_replacement_program', '_wildcard_numbers', '_short_string', '_variables')
+
+    # Each head (class name) is given one of 64 bits, a node's _head_mask has the bits of all the heads
+    # in it (apart from wildcards, which can match anything), so a pattern can only match in the node
+    # if its mask is a subset of the node's. Set in __new__ of the concrete classes
+    _head_bit: int = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._head_bit = 1 << (hash(cls.__name__) & 63)
+
+    @classmethod
+    def _new_interned(cls, key: Tuple) -> Tuple[Expression, bool]:
+        """ Get the interned node for `key`, creating an empty one if it doesn't exist,
+        returns the node and whether it was newly created (and so needs its fields setting)"""
+        node = _intern_cache.get(key)
+        if node is not None:
+            return node, False
+
+        node = object.__new__(cls)
+        node._compiled = None
+        node._derivatives = None
+        node._simplified = None
+        node._reduced = None
+        node._matches = None
+        node._match_program = None
+        node._replacement_program = None
+        node._short_string = None
+        node._variables = None
+        _intern_cache[key] = node
+        return node, True
+
     # Generally useful things for navigating an expression
 
     @property
@@ -71,16 +132,31 @@ class Expression:
     def terms(self) -> List[Expression]:
         raise NotImplementedError(f"terms not implemented in {self.__class__.__name__}")
 
+    def _postorder(self) -> Iterator[Expression]:
+        """ Each distinct node in this expression, after all of its terms, found using a stack rather than
+        recursively. Visiting nodes in this order before a memoised recursive pass means each call in
+        that pass only goes one level deep, so very deep expressions don't hit the recursion limit"""
+        done = set()
+        stack: List[Tuple[Expression, bool]] = [(self, False)]
+        while stack:
+            node, terms_done = stack.pop()
+            if id(node) in done:
+                continue
+
+            if terms_done:
+                done.add(id(node))
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend((term, False) for term in reversed(node.terms))
+
     # Don't have a full-blown substitution system right now
     def wildcard_substitute(self, wildcard_id: int, expression: Expression):
         raise NotImplementedError(f"wildcard_substitute not implemented in {self.__class__.__name__}")
 
     @property
-    def wildcard_numbers(self) -> Set[int]:
-        out = set()
-        for term in self.terms:
-            out.update(term.wildcard_numbers)
-        return out
+    def wildcard_numbers(self) -> FrozenSet[int]:
+        return self._wildcard_numbers
 
     def replace(self, source_pattern: Expression, target_pattern: Expression) -> Expression:
         return self.substitute(source_pattern, target_pattern).simplify()
@@ -94,12 +170,65 @@ class Expression:
         # print(f"Attempting substution in {self.short_string()}:", end="")
         # print(f"  {source_pattern.short_string()} -> {target_pattern.short_string()}")
 
-        return self._substitute(source_pattern, target_pattern)
+        # Bottom up, using a stack rather than recursion, parts of the expression without
+        # the heads in the source pattern can't contain a match, so they are not descended into
+        substituted: Dict[int, Expression] = {}
+        stack: List[Tuple[Expression, bool]] = [(self, False)]
+        while stack:
+            node, terms_done = stack.pop()
+            if id(node) in substituted:
+                continue
 
-    def _substitute(self, source_pattern: Expression, target_pattern: Expression) -> Expression:
-        raise NotImplementedError(f"{self.__class__.__name__} does not implement _substitute")
+            if source_pattern._head_mask & ~node._head_mask:
+                substituted[id(node)] = node
+
+            elif terms_done or len(node.terms) == 0:
+                substituted[id(node)] = node._substitute(source_pattern, target_pattern, substituted)
+
+            else:
+                stack.append((node, True))
+                stack.extend((term, False) for term in node.terms)
+
+        return substituted[id(self)]
+
+    def _substitute(self,
+                    source_pattern: Expression,
+                    target_pattern: Expression,
+                    substituted: Dict[int, Expression]) -> Expression:
+        """ Substitution at this node, `substituted` has the result of substituting in each of its terms """
+
+        terms = self.terms
+        new_terms = [substituted[id(term)] for term in terms]
+
+        # Nodes are interned, so unchanged terms mean this node is unchanged, no need to rebuild it
+        if all(new_term is term for new_term, term in zip(new_terms, terms)):
+            new_self = self
+        else:
+            new_self = self.__class__(*new_terms)
+
+        match_data = source_pattern.match(new_self)
+
+        if match_data is not None:
+            return _replace_wildcards(target_pattern, match_data)
+
+        else:
+            return new_self
 
     def simplify(self, max_iters=100, debug=False) -> Expression:
+        if debug:
+            return self._simplify(max_iters, debug)
+
+        if self._simplified is None:
+            self._simplified = {}
+
+        simplified = self._simplified.get(max_iters)
+        if simplified is None:
+            simplified = self._simplify(max_iters, debug)
+            self._simplified[max_iters] = simplified
+
+        return simplified
+
+    def _simplify(self, max_iters, debug) -> Expression:
         last_expression = self
         new_expression = self
         for i in range(max_iters):
@@ -116,17 +245,20 @@ class Expression:
             #  ... this must be why Mathematica has Plus and Times with an arbritrary length
 
             # Try all the simplifying substitutions once again
-            for source, target in simplification_substitutions:
-                if debug:
-                    newer_expression = new_expression.substitute(source, target)
-                    if newer_expression != new_expression:
-                        print("Simplifed to:", newer_expression.short_string())
-                        print("Rule:", source, "->", target)
-                else:
-                    new_expression = new_expression.substitute(source, target)
+            seen = {}
+            for node in new_expression._postorder():
+                node._rewrite(_simplification_rules, seen, debug)
+
+            _, new_expression = seen[id(new_expression)]
 
             if new_expression.full_identity(last_expression):
                 last_expression = new_expression
+
+                # Simplifying again won't do anything
+                if last_expression._simplified is None:
+                    last_expression._simplified = {}
+                last_expression._simplified[max_iters] = last_expression
+
                 break
 
             last_expression = new_expression
@@ -136,11 +268,61 @@ class Expression:
 
         return last_expression
 
+    def _rewrite(self,
+                 rules: Dict[Type[Expression], List[Tuple[Expression, Expression]]],
+                 seen: Dict[int, Tuple[Expression, Expression]],
+                 debug: bool=False) -> Expression:
+        """ A single bottom-up pass of rule based rewriting, each node is rebuilt from its
+        rewritten terms, and then the first of the rules for its head that matches is applied.
+        The replacement is rewritten in turn, so the result is one that no rule applies to
+        (all the rules make expressions smaller, so this ends).
+        `rules` are (source, target) pairs indexed by the class of the source pattern,
+        `seen` maps the ids of nodes already rewritten in this pass to the node and its result, results are
+        included (mapping to themselves), so rewriting a replacement only visits its new nodes.
+        Nodes are kept in `seen` as well as their ids, as replacements are temporary, and the id of one
+        that has been freed could be reused by a different node later in the pass"""
+
+        entry = seen.get(id(self))
+        if entry is not None:
+            return entry[1]
+
+        terms = self.terms
+        new_terms = [term._rewrite(rules, seen, debug) for term in terms]
+        if all(new is old for new, old in zip(new_terms, terms)):
+            out = self
+        else:
+            out = self.__class__(*new_terms)
+
+        for source, target in rules.get(out.__class__, ()):
+            if source._head_mask & ~out._head_mask:
+                continue
+
+            match_data = source.match(out)
+            if match_data is not None:
+                replacement = _replace_wildcards(target, match_data)
+
+                if debug:
+                    print("Simplifed to:", replacement.short_string())
+                    print("Rule:", source, "->", target)
+
+                out = replacement._rewrite(rules, seen, debug)
+                break
+
+        else:
+            # No rule applies
+            seen[id(out)] = (out, out)
+
+        seen[id(self)] = (self, out)
+        return out
+
     def reduce_constants(self):
         """ Attempt to reduce the prevelance of constants,
         this basically unwraps the constant values,
         and evaluates the expressions again"""
-        reduced = self._reduce_constants()
+        for node in self._postorder():
+            node._memoised_reduce_constants()
+
+        reduced = self._memoised_reduce_constants()
 
         if isinstance(reduced, Expression):
             return reduced
@@ -148,52 +330,52 @@ class Expression:
             # Must be a number
             return Constant(reduced)
 
+    def _memoised_reduce_constants(self):
+        """ _reduce_constants, kept on the node, so when simplifying, only parts of the expression
+        that have been rewritten need reducing again"""
+        if self._reduced is None:
+            self._reduced = self._reduce_constants()
+
+        return self._reduced
+
     def _reduce_constants(self):
         raise NotImplementedError(f"reduce_constants not implemented in {self.__class__.__name__}")
 
     def match(self, expression: Expression) -> Optional[Dict[int, Expression]]:
-        # Check that `expression` does not contain wildcards
+        """ Match `expression` against this pattern, returning the expression for each wildcard,
+        or None if it doesn't match. Results are kept on `expression` (the same patterns are tried
+        on the same nodes many times when simplifying), so the returned dict must not be modified"""
 
-        if len(expression.wildcard_numbers) != 0:
-            raise MatchError("Wildcard in target expression")
+        if expression._matches is None:
+            expression._matches = {}
+        else:
+            match_data = expression._matches.get(self, _no_match_data)
+            if match_data is not _no_match_data:
+                return match_data
 
-        try:
-            match_data = self._match(expression)
+        match_data = self._uncached_match(expression)
+        expression._matches[self] = match_data
+        return match_data
 
-            # If there are multiple uses of a wildcard, check their contents is the same
-            output_dict: Dict[int, Expression] = {}
-            for key in match_data:
-                if len(match_data[key]) > 1:
-                    ref = match_data[key][0]
-                    for other in match_data[key][1:]:
-                        ref.match(other)  # Should raise a MatchFailed exception if it doesn't work
+    def _uncached_match(self, expression: Expression) -> Optional[Dict[int, Expression]]:
+        # Check that `expression` does not contain wildcards
 
-                output_dict[key] = match_data[key][0]
-            return output_dict
+        if len(expression.wildcard_numbers) != 0:
+            raise MatchError("Wildcard in target expression")
 
-        except MatchFailure:
+        # Can't match if the pattern has heads that the expression doesn't
+        if self._head_mask & ~expression._head_mask:
             return None
 
-    def _match(self, expression: Expression) -> Dict[int, List[Expression]]:
+        if self._match_program is None:
+            self._match_program = _compile_pattern(self)
 
-        """
-        Recursively defined, matching failure indicated via an exception being raised
-
-        Overriden by special objects - Constant, Variable, Wildcard
+        return _run_match_program(self._match_program, expression)
 
-        """
-
-        if self.head != expression.head:  # Checks class name, not class object - probably good for serialisation
-            raise MatchFailure(self, expression)
-
-        # Recursively check internals
-        output_dict: Dict[int, List[Expression]] = defaultdict(list)
-        for p, e in zip(self.terms, expression.terms):
-            match_data = p._match(e)
-            for key in match_data:
-                output_dict[key] += match_data[key]
-
-        return output_dict
+    def _match(self, expression: Expression) -> bool:
+        """ Whether this leaf pattern (Constant, Variable) matches `expression`,
+        see _compile_pattern for how patterns are matched generally"""
+        raise NotImplementedError(f"_match not implemented in {self.__class__.__name__}")
 
     def matches(self, pattern: Expression) -> bool:
         return self.match(pattern) is not None
@@ -207,12 +389,33 @@ class Expression:
     def fast_diff(self, term: Variable) -> Expression:
         """ Differentiate without any simplification of the result"""
         if self.differentiable:
-            return self._diff(term)
+            if self._derivatives is None:
+                self._derivatives = {}
+
+            derivative = self._derivatives.get(term)
+            if derivative is None:
+                derivative = self._memoised_diff(term, {})
+                self._derivatives[term] = derivative
+
+            return derivative
         else:
             raise NonDifferentiableExpressionError(
                 f"Cannot differentiate Expression object of type {self.__class__.__name__}")
 
-    def _diff(self, term: Variable) -> Expression:
+    def _memoised_diff(self, term: Variable, cache: Dict[int, Expression]) -> Expression:
+        """ Differentiate, reusing the result for any node already differentiated with the same cache,
+        so that nodes shared between several parts of the expression are only differentiated once.
+        The cache belongs to a single fast_diff call (so a single term), and nodes are interned,
+        so it is keyed on the node id"""
+
+        derivative = cache.get(id(self))
+        if derivative is None:
+            derivative = self._diff(term, cache)
+            cache[id(self)] = derivative
+
+        return derivative
+
+    def _diff(self, term: Variable, cache: Dict[int, Expression]) -> Expression:
         """Differentiate this expression with respect to a variable"""
 
         raise NotImplementedError(f"diff not implemented in {self.__class__.__name__}")
@@ -225,8 +428,69 @@ class Expression:
     # Evaluation
 
     def __call__(self, variable_map: Dict[Variable, Any]):
+        """ Evaluate this expression, `variable_map` gives the value of each variable (by identity).
+        Values can be numbers or numpy arrays, arrays are evaluated elementwise (with broadcasting),
+        so a batch of values for the variables is evaluated with one numpy call per node"""
         raise NotImplementedError(f"__call__ not implemented in {self.__class__.__name__}")
 
+    def batch_call(self, variable_map: Dict[bytes, Any]):
+        """ Evaluate for a batch of values of the variables, given as arrays or sequences that broadcast
+        together. This uses the compiled form of the expression (see compile), which writes into
+        arrays it has already allocated, rather than making a new one for every node"""
+        return self.compile()({
+            identity: np.asarray(value) if isinstance(value, (list, tuple)) else value
+            for identity, value in variable_map.items()})
+
+    def cse(self) -> Expression:
+        """ Common subexpression elimination. Identical subexpressions are already shared
+        because nodes are interned, this also puts the operands of commutative operations
+        into a canonical order, so that, for example, a*b and b*a become the same node"""
+        seen = {}
+        for node in self._postorder():
+            node._cse(seen)
+
+        return self._cse(seen)
+
+    def _cse(self, seen: Dict[int, Expression]) -> Expression:
+        return self
+
+    def flatten(self) -> Expression:
+        """ Replace chains of Plus and Times with single Sum and Product nodes,
+        so that, for example, ((a + b) + c) + d becomes Sum(a, b, c, d).
+        Numbers in each chain are combined into one constant (as they are when a node is made from numbers),
+        and additions of 0 and multiplications by 1 are dropped, nothing else is simplified"""
+        seen = {}
+        for node in self._postorder():
+            node._flatten(seen)
+
+        return self._flatten(seen)
+
+    def _flatten(self, seen: Dict[int, Expression]) -> Expression:
+        return self
+
+    def compile(self, dtype=None) -> CompiledExpression:
+        """ Flatten this expression into a list of instructions that can be evaluated
+        without walking the tree, expressions are immutable so this is only done once.
+        If `dtype` is given (e.g. np.float32) the evaluation is done in that type"""
+        if self._compiled is None:
+            from evaluation import compile_expression
+            self._compiled = compile_expression(self.cse())
+
+        if dtype is None:
+            return self._compiled
+        else:
+            return self._compiled.with_dtype(dtype)
+
+    def function(self, dtype=None) -> CompiledFunction:
+        """ This expression as a single generated python function, which makes one python call
+        for the whole expression, rather than one per node (see CompiledExpression.source)"""
+        return self.compile(dtype=dtype).function()
+
+    def jit(self, fastmath: bool = False, dtype=None, parallel: bool = False) -> CompiledFunction:
+        """ Compile this expression to native code with numba (if it is installed),
+        see CompiledExpression.jit for the options"""
+        return self.compile(dtype=dtype).jit(fastmath=fastmath, parallel=parallel)
+
     # Algabraic methods
 
     @staticmethod
@@ -234,10 +498,15 @@ class Expression:
         """ Takes inputs that might be numbers, expressions, or something else,
         and return an Expression"""
 
-        if isinstance(value, (int, float, Fraction, np.ndarray)):
-            return Constant(value)
-        elif isinstance(value, Expression):
+        # Already an expression is the common case, then exact type lookup for numbers
+        if isinstance(value, Expression):
             return value
+
+        handler = _sanitise_dispatch.get(type(value))
+        if handler is not None:
+            return handler(value)
+        elif isinstance(value, (int, float, Fraction, np.ndarray)):
+            return Constant(value)
         else:
             if operation_name is not None:
                 raise TypeError(f"Invalid input to operation '{operation_name}': {repr(value)}")
@@ -275,7 +544,7 @@ class Expression:
         other = Expression._sanitise(other, "/")
         return Divide(self, other)
 
-    def __rdiv__(self, other):
+    def __rtruediv__(self, other):
         other = Expression._sanitise(other, "/")
         return Divide(other, self)
 
@@ -314,8 +583,18 @@ class Expression:
     # Comparisons
     #
 
+    # Nodes are interned, so structurally identical expressions are the same object, and hashing and
+    # equality are by identity - this is what the caches keyed on expressions rely on.
+    # Pinned here so that subclasses don't accidentally override them
+
+    __hash__ = object.__hash__
+
+    def __eq__(self, other):
+        return self is other
+
     def full_identity(self, other: Expression) -> bool:
-        raise NotImplementedError(f"{self.__class__.__name__} does not implement full_identity")
+        """ Structural equality, which, because of interning, is the same as being the same object"""
+        return self is other
 
     #
     # Strings
@@ -328,10 +607,48 @@ class Expression:
         return "\n".join(self._pretty_print_lines(indent_str))
 
     def _pretty_print_lines(self, indent_str: str) -> List[str]:
+        # Built iteratively with the depth of each line known, rather than indenting
+        # the lines of each term again at every level above it
+        lines = []
+        stack: List[Tuple[Expression, int, str]] = [(self, 0, "")]  # node, depth, suffix for its last line
+        while stack:
+            node, depth, suffix = stack.pop()
+            terms = node.terms
+            if terms:
+                lines.append(indent_str*depth + f"{node.__class__.__name__}(")
+                stack.append((terms[-1], depth + 1, ")" + suffix))
+                for term in reversed(terms[:-1]):
+                    stack.append((term, depth + 1, ","))
+            else:
+                lines.append(indent_str*depth + node._pretty_print_leaf() + suffix)
+
+        return lines
+
+    def _pretty_print_leaf(self) -> str:
         raise NotImplementedError(f"`pretty_print` not implemented in {self.__class__.__name__}")
 
-    def short_string(self):
-        return repr(self)
+    def short_string(self) -> str:
+        """ Compact string form of this expression, expressions are immutable, so this is kept"""
+        if self._short_string is None:
+            # Built from the parts of each node using a stack, rather than recursively
+            parts = []
+            stack: List[Union[str, Expression]] = [self]
+            while stack:
+                part = stack.pop()
+                if isinstance(part, str):
+                    parts.append(part)
+                elif part._short_string is not None:
+                    parts.append(part._short_string)
+                else:
+                    stack.extend(reversed(part._short_string_parts()))
+
+            self._short_string = "".join(parts)
+
+        return self._short_string
+
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        """ Strings and terms that make up the short string of this node"""
+        return [repr(self)]
 
     def short_print(self, file=None):
         print(self.short_string(), file=file)
@@ -341,32 +658,52 @@ class Expression:
     #
 
     def variables(self) -> List[Tuple[bytes, Optional[str]]]:
+        """ (identity, print alias) of each variable in the expression, sorted by identity,
+        expressions are immutable, so this is only worked out once"""
 
-        alias_lookup = {}
-        for term in self.terms:
-            if isinstance(term, Variable):
-                alias_lookup[term.identity] = term.print_alias
-            else:
-                alias_lookup.update(term.variables())
+        if self._variables is None:
+            alias_lookup = {}
+            for node in self._postorder():
+                if isinstance(node, Variable):
+                    alias_lookup[node.identity] = node.print_alias
 
-        sorted_keys = sorted(alias_lookup.keys())
+            self._variables = tuple((key, alias_lookup[key]) for key in sorted(alias_lookup.keys()))
 
-        return [(key, alias_lookup[key]) for key in sorted_keys]
+        return list(self._variables)
 
     def serialise(self):
         variables = self.variables()
-        variable_ids = [v[0] for v in self.variables()]
+        variable_ids = [v[0] for v in variables]
         variable_lookup = {var: ind for ind, var in enumerate(variable_ids)}
         variable_table = encode_variable_table(variables)
 
         return variable_table + self._serialise(variable_lookup)
 
     def _serialise(self, variable_lookup: Dict[bytes, int]) -> bytes:
-        if self.__class__ in expression_encoding:
-            return expression_encoding[self.__class__].to_bytes(EncodingSettings.expression_bytes, EncodingSettings.endianness) + \
-                   self._serialisation_details(variable_lookup)
+        """ Encode the expression (without the variable table). Nodes are written in pre-order,
+        each one being its class code followed by its details, into a single buffer"""
+
+        expression_bytes = EncodingSettings.expression_bytes
+        endianness = EncodingSettings.endianness
+
+        out = bytearray()
+        stack: List[Expression] = [self]
+        while stack:
+            node = stack.pop()
+
+            code = expression_encoding.get(node.__class__)
+            if code is None:
+                raise NoEncodingEntry(f"No encoding found for class {node.__class__}")
+
+            out += code.to_bytes(expression_bytes, endianness)
+            out += node._serialisation_details(variable_lookup)
+
+            stack.extend(reversed(node.terms))
+
+        return bytes(out)
 
     def _serialisation_details(self, variable_lookup: Dict[bytes, int]) -> bytes:
+        """ Encoded data for this node, not including its terms, which follow it """
         raise NoEncodingEntry(f"No encoding found for class {self.__class__}")
 
     @staticmethod
@@ -385,7 +722,7 @@ class Expression:
 
         expr, expr_length = \
             Expression._deserialise_with_size(
-                data[variable_table_length:],
+                memoryview(data)[variable_table_length:],
                 variables)
 
         return expr, variable_table_length + expr_length
@@ -394,38 +731,246 @@ class Expression:
     def _deserialise_with_size(
             data: bytes,
             variable_lookup: List[Variable]) -> Tuple[Expression, int]:
+        """ Decode an expression (without the variable table), returns it with the number of bytes read.
+        The data is read through a memoryview at an offset, so it is not copied, and the pre-order
+        nodes are put back together using a stack of nodes that are waiting for their terms"""
+
+        data = memoryview(data)
+
+        expression_bytes = EncodingSettings.expression_bytes
+        endianness = EncodingSettings.endianness
+
+        # (class, details, number of terms, terms read so far) for nodes that still need terms
+        waiting: List[Tuple[Type[Expression], Any, int, List[Expression]]] = []
+
+        offset = 0
+        while True:
+            expr_cls_id = int.from_bytes(data[offset:offset + expression_bytes], endianness, signed=False)
+            expr_cls = expression_decoding[expr_cls_id]
+
+            details, n_terms, offset = expr_cls._read_details(expr_cls, data, offset + expression_bytes, variable_lookup)
 
-        expr_bytes = data[:EncodingSettings.expression_bytes]
-        expr_cls_id = int.from_bytes(expr_bytes, EncodingSettings.endianness, signed=False)
-        expr_cls = expression_decoding[expr_cls_id]
+            if n_terms > 0:
+                waiting.append((expr_cls, details, n_terms, []))
+                continue
 
-        rest = data[EncodingSettings.expression_bytes:]
+            expr = expr_cls._from_details(expr_cls, details, [])
 
-        expr, length = expr_cls._create_from_bytes(expr_cls, rest, variable_lookup)
+            # Finish any nodes that now have all their terms
+            while waiting:
+                cls, details, n_terms, terms = waiting[-1]
+                terms.append(expr)
+                if len(terms) < n_terms:
+                    break
 
-        return expr, EncodingSettings.expression_bytes + length
+                waiting.pop()
+                expr = cls._from_details(cls, details, terms)
+
+            else:
+                return expr, offset
 
     @staticmethod
-    def _create_from_bytes(
+    def _read_details(
             cls: Type[Expression],
-            data: bytes,
-            variable_lookup: List[Variable]) -> Tuple[Expression, int]:
+            data: memoryview,
+            offset: int,
+            variable_lookup: List[Variable]) -> Tuple[Any, int, int]:
+        """ Read the data written by _serialisation_details, starting at `offset`,
+        returns the details, the number of terms that follow, and the offset after the details"""
+
+        raise NotImplementedError(f"Cannot instance of '{cls.__name__}' - no implemenation of '_read_details'")
+
+    @staticmethod
+    def _from_details(cls: Type[Expression], details: Any, terms: List[Expression]) -> Expression:
+        """ Make a node from the output of _read_details and its decoded terms"""
+        return cls(*terms)
+
+
+
+def _replace_wildcards(target_pattern: Expression, match_data: Dict[int, Expression]) -> Expression:
+    """ Put the matched expressions into the wildcards of a pattern"""
+    if target_pattern._replacement_program is None:
+        target_pattern._replacement_program = _compile_replacement(target_pattern)
+
+    return _run_replacement_program(target_pattern._replacement_program, match_data)
+
+
+# Replacements are built by compiling the target pattern to a post-order list of (opcode, argument) steps,
+# so the replacement is made in one pass, rather than one pass over the pattern for each wildcard:
+#   _PUSH_NODE node - push a part of the pattern that has no wildcards in it
+#   _PUSH_WILDCARD number - push the expression bound to a wildcard
+#   _BUILD_NODE (class, number of terms) - make a node from the terms on top of the stack
+
+_PUSH_NODE = 0
+_PUSH_WILDCARD = 1
+_BUILD_NODE = 2
+
+ReplacementProgram = Tuple[Tuple[int, Any], ...]
+
+
+def _compile_replacement(pattern: Expression) -> ReplacementProgram:
+    """ Make the replacement program for a target pattern """
+    program = []
+    stack: List[Tuple[Expression, bool]] = [(pattern, False)]
+    while stack:
+        node, terms_done = stack.pop()
+        if isinstance(node, Wildcard):
+            program.append((_PUSH_WILDCARD, node.number))
+        elif len(node.wildcard_numbers) == 0:
+            program.append((_PUSH_NODE, node))
+        elif terms_done:
+            program.append((_BUILD_NODE, (node.__class__, len(node.terms))))
+        else:
+            stack.append((node, True))
+            stack.extend((term, False) for term in reversed(node.terms))
+
+    return tuple(program)
+
+
+def _run_replacement_program(program: ReplacementProgram, match_data: Dict[int, Expression]) -> Expression:
+    """ Build a replacement using the program from _compile_replacement """
+    stack: List[Expression] = []
+    for opcode, argument in program:
+        if opcode == _PUSH_NODE:
+            stack.append(argument)
+
+        elif opcode == _PUSH_WILDCARD:
+            stack.append(match_data[argument])
+
+        else:
+            cls, n_terms = argument
+            terms = stack[len(stack) - n_terms:]
+            del stack[len(stack) - n_terms:]
+            stack.append(cls(*terms))
+
+    return stack[0]
+
+
+# Patterns are matched by compiling them to a flat program, a pre-order list of (opcode, argument) steps,
+# each of which takes the next node of the expression from a stack:
+#   _MATCH_NODE (class, number of terms, term classes) - check the node's class and number of terms,
+#       and the classes of any terms that aren't wildcards (so most failures are found before descending),
+#       then push its terms
+#   _MATCH_LEAF pattern - check the node against a Constant or Variable pattern
+#   _BIND_WILDCARD slot - bind the node to a wildcard, or if it is already bound, check it is the same node
+#       (or a variable with the same identity)
+# Wildcards are bound in a list, each wildcard number in the pattern is given a slot in it when compiling
+
+_MATCH_NODE = 0
+_MATCH_LEAF = 1
+_BIND_WILDCARD = 2
+
+MatchProgram = Tuple[Tuple[Tuple[int, Any], ...], Tuple[int, ...]]
+
+
+def _compile_pattern(pattern: Expression) -> MatchProgram:
+    """ Make the match program for a pattern, returns the steps and the wildcard number for each slot"""
+    program = []
+    slots: Dict[int, int] = {}
+    stack = [pattern]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Wildcard):
+            slot = slots.setdefault(node.number, len(slots))
+            program.append((_BIND_WILDCARD, slot))
+        else:
+            terms = node.terms
+            if len(terms) == 0:
+                program.append((_MATCH_LEAF, node))
+            else:
+                term_classes = tuple(
+                    (i, term.__class__) for i, term in enumerate(terms) if not isinstance(term, Wildcard))
+
+                program.append((_MATCH_NODE, (node.__class__, len(terms), term_classes)))
+                stack.extend(reversed(terms))
 
-        raise NotImplementedError(f"Cannot instance of '{cls.__name__}' - no implemenation of '_create_from_bytes'")
+    return tuple(program), tuple(slots)
 
 
+def _run_match_program(match_program: MatchProgram, expression: Expression) -> Optional[Dict[int, Expression]]:
+    """ Match an expression using the program from _compile_pattern, returns the expression
+    bound to each wildcard, or None if it doesn't match"""
+    program, wildcard_numbers = match_program
+    bindings: List[Optional[Expression]] = [None] * len(wildcard_numbers)
+    stack = [expression]
+    for opcode, argument in program:
+        node = stack.pop()
+
+        if opcode == _MATCH_NODE:
+            cls, n_terms, term_classes = argument
+            if node.__class__ is not cls:
+                return None
+
+            terms = node.terms
+            if len(terms) != n_terms:
+                return None
+
+            for i, term_class in term_classes:
+                if terms[i].__class__ is not term_class:
+                    return None
+
+            stack.extend(reversed(terms))
+
+        elif opcode == _MATCH_LEAF:
+            if not argument._match(node):
+                return None
+
+        else:
+            # Nodes are interned, so repeated wildcards must be bound to the same object,
+            # except for variables, which are interned with their print alias
+            bound = bindings[argument]
+            if bound is None:
+                bindings[argument] = node
+            elif bound is not node and not (
+                    bound.__class__ is Variable and node.__class__ is Variable and bound.identity == node.identity):
+                return None
+
+    return dict(zip(wildcard_numbers, bindings))
+
 
 #
 # Special Expressions
 #
 
 
+def _constant_key(value: Any) -> Tuple:
+    """ Key used for interning constants, the type is included so that 1 and 1.0 are distinct,
+    and the sign is included for floats so that 0.0 and -0.0 are too """
+    if isinstance(value, (float, np.floating)):
+        return Constant, type(value), value, math.copysign(1.0, value)
+
+    try:
+        hash(value)
+    except TypeError:
+        # Unhashable (numpy arrays), these are only shared if they are the same object
+        return Constant, type(value), id(value)
+
+    return Constant, type(value), value
+
+
+# Small integer constants are used all the time (by differentiation and simplification),
+# these are kept alive here and looked up directly, without making an interning key
+_small_constants: Dict[int, Constant] = {}
+
+
 class Constant(Expression):
     """ Represents a constant"""
-    def __init__(self, value: EncodableNumber):
+    __slots__ = ('value',)
+
+    def __new__(cls, value: EncodableNumber):
         # This should NOT be a subtype of Unary, because it is the result of
         # Expression._sanitise when given a number
-        self.value = value
+        if type(value) is int:
+            node = _small_constants.get(value)
+            if node is not None:
+                return node
+
+        node, created = cls._new_interned(_constant_key(value))
+        if created:
+            node.value = value
+            node._head_mask = cls._head_bit
+            node._wildcard_numbers = _no_wildcards
+        return node
 
     def __repr__(self):
         return repr(self.value)
@@ -437,41 +982,28 @@ class Constant(Expression):
     def wildcard_substitute(self, wildcard_id: int, expression: Expression):
         return self
 
-    def _match(self, expression: Expression) -> Dict[int, List[Expression]]:
-        if not isinstance(expression, Constant):
-            raise MatchFailure(self, expression)
+    def _match(self, expression: Expression) -> bool:
+        if self is expression:
+            return True
 
-        if self.value != expression.value:
-            raise MatchFailure(self, expression)
+        if expression.__class__ is not Constant:
+            return False
 
-        return {}
+        # Arrays are only matched by the same constant
+        if isinstance(self.value, np.ndarray) or isinstance(expression.value, np.ndarray):
+            return False
 
-    def _pretty_print_lines(self, indent_str: str) -> List[str]:
-        return [str(self.value)]
+        return self.value == expression.value
 
-    def _diff(self, term):
-        return Constant(0)
+    def _pretty_print_leaf(self) -> str:
+        return str(self.value)
+
+    def _diff(self, term, cache: Dict[int, Expression]):
+        return ZERO
 
     def __call__(self, x):
         return self.value
 
-    def _substitute(self, source_pattern: Expression, target_pattern: Expression) -> Expression:
-
-        match_data = source_pattern.match(self)
-
-        if match_data is not None:
-            replacement = target_pattern
-            for key in match_data:
-                replacement = replacement.wildcard_substitute(key, match_data[key])
-
-            return replacement
-
-        else:
-            return self
-
-    def full_identity(self, other: Expression) -> bool:
-        return other.head == self.head and self.value == other.value
-
     def _reduce_constants(self):
         return self.value
 
@@ -483,33 +1015,64 @@ class Constant(Expression):
         return encode_numeric(self.value)
 
     @staticmethod
-    def _create_from_bytes(
+    def _read_details(
             cls: Type[Expression],
-            data: bytes,
-            variable_lookup: List[Variable]) -> Tuple[Expression, int]:
+            data: memoryview,
+            offset: int,
+            variable_lookup: List[Variable]) -> Tuple[Any, int, int]:
+
+        number, length = decode_numeric_with_size(data[offset:])
+        return number, 0, offset + length
+
+    @staticmethod
+    def _from_details(cls: Type[Expression], details: Any, terms: List[Expression]) -> Expression:
+        return Constant(details)
 
-        number, length = decode_numeric_with_size(data)
-        return Constant(number), length
+
+# Conversions used by Expression._sanitise, keyed by exact type
+_sanitise_dispatch: Dict[type, Callable[[Any], Expression]] = {
+    number_type: Constant
+    for number_type in (int, float, Fraction, np.ndarray, np.float64, np.float32, np.int64, np.int32)}
+
+_small_constants.update((value, Constant(value)) for value in range(-128, 257))
+
+ZERO = Constant(0)
+ONE = Constant(1)
+TWO = Constant(2)
 
 
 class Variable(Expression):
 
-    def __init__(self, identity: Union[bytes, str], print_alias: Optional[str]=None):
+    __slots__ = ('identity', 'print_alias', '_aliased')
+
+    def __new__(cls, identity: Union[bytes, str], print_alias: Optional[str]=None):
 
         if isinstance(identity, str):
-            self.identity = identity.encode('utf-8')
-        elif isinstance(identity, bytes):
-            self.identity = identity
+            identity = identity.encode('utf-8')
 
         # print_alias of none and "" are treated equivalently,
         # this should match with the serialisation method.
 
-        if print_alias is None or print_alias == "":
-            self.aliased = str(self.identity)
-            self.print_alias = None
-        else:
-            self.print_alias = print_alias
-            self.aliased = print_alias
+        if print_alias == "":
+            print_alias = None
+
+        node, created = cls._new_interned((cls, identity, print_alias))
+        if created:
+            node.identity = identity
+            node.print_alias = print_alias
+            node._aliased = print_alias
+            node._head_mask = cls._head_bit
+            node._wildcard_numbers = _no_wildcards
+
+        return node
+
+    @property
+    def aliased(self) -> str:
+        """ The print alias, or the string form of the identity if there isn't one (made when first needed)"""
+        if self._aliased is None:
+            self._aliased = str(self.identity)
+
+        return self._aliased
 
     def __repr__(self):
         return self.aliased
@@ -521,45 +1084,25 @@ class Variable(Expression):
     def wildcard_substitute(self, wildcard_id: int, expression: Expression):
         return self
 
-    def _match(self, expression: Expression) -> Dict[int, List[Expression]]:
-
-        if not isinstance(expression, Variable):
-            raise MatchFailure(self, expression)
+    def _match(self, expression: Expression) -> bool:
+        # Variables are interned, but with their print alias, so the same identity might be a different node
+        if self is expression:
+            return True
 
-        if self.identity != expression.identity:
-            raise MatchFailure(self, expression)
+        return expression.__class__ is Variable and self.identity == expression.identity
 
-        return {}
-
-    def _pretty_print_lines(self, indent_str: str) -> List[str]:
-        return [self.aliased]
+    def _pretty_print_leaf(self) -> str:
+        return self.aliased
 
-    def _diff(self, term: Variable):
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
         if term.identity == self.identity:
-            return Constant(1)
+            return ONE
         else:
-            return Constant(0)
+            return ZERO
 
     def __call__(self, x):
         return x[self.identity]
 
-    def _substitute(self, source_pattern: Expression, target_pattern: Expression) -> Expression:
-
-        match_data = source_pattern.match(self)
-
-        if match_data is not None:
-            replacement = target_pattern
-            for key in match_data:
-                replacement = replacement.wildcard_substitute(key, match_data[key])
-
-            return replacement
-
-        else:
-            return self
-
-    def full_identity(self, other: Expression) -> bool:
-        return self.head == other.head and self.identity == other.identity
-
     def _reduce_constants(self):
         return self
 
@@ -577,22 +1120,35 @@ class Variable(Expression):
             signed=False)
 
     @staticmethod
-    def _create_from_bytes(
+    def _read_details(
             cls: Type[Expression],
-            data: bytes,
-            variable_lookup: List[Variable]) -> Tuple[Expression, int]:
+            data: memoryview,
+            offset: int,
+            variable_lookup: List[Variable]) -> Tuple[Any, int, int]:
 
+        end = offset + EncodingSettings.variable_index_bytes
         variable_index = \
-            int.from_bytes(data[:EncodingSettings.variable_index_bytes],
+            int.from_bytes(data[offset:end],
                            EncodingSettings.endianness,
                            signed=False)
 
-        return variable_lookup[variable_index], EncodingSettings.variable_index_bytes
+        return variable_lookup[variable_index], 0, end
+
+    @staticmethod
+    def _from_details(cls: Type[Expression], details: Any, terms: List[Expression]) -> Expression:
+        return details
 
 
 class Wildcard(Expression):
-    def __init__(self, number):
-        self.number = number
+    __slots__ = ('number',)
+
+    def __new__(cls, number: int):
+        node, created = cls._new_interned((cls, number))
+        if created:
+            node.number = number
+            node._head_mask = 0
+            node._wildcard_numbers = frozenset((number, ))
+        return node
 
     @property
     def differentiable(self):
@@ -611,25 +1167,18 @@ class Wildcard(Expression):
         else:
             return self
 
-    @property
-    def wildcard_numbers(self) -> Set[int]:
-        return {self.number}
-
-    def _match(self, expression: Expression):
-        return {self.number: [expression]}
-
-    def _pretty_print_lines(self, indent_str: str) -> List[str]:
-        return [f"<{self.number}>"]
+    def _pretty_print_leaf(self) -> str:
+        return f"<{self.number}>"
 
     def __call__(self, x):
         raise EvaluationError("Wildcards cannot be evaluated")
 
-    def _substitute(self, source_pattern: Expression, target_pattern: Expression) -> Expression:
+    def _substitute(self,
+                    source_pattern: Expression,
+                    target_pattern: Expression,
+                    substituted: Dict[int, Expression]) -> Expression:
         raise SubstitutionError("Attempted to substitute into expression with a wildcard")
 
-    def full_identity(self, other: Expression) -> bool:
-        return self.head == other.head and self.number == other.number
-
     def _reduce_constants(self):
         return self
 
@@ -639,10 +1188,65 @@ class Wildcard(Expression):
 #
 
 
+def _fold_constants(operation: Callable, *constants: Constant) -> Optional[Constant]:
+    """ Evaluate an operation on constants when the node for it is made, returns None if it should be kept
+    as a node: for arrays (which would be copied into every expression using them), for operations
+    that aren't valid, such as log(-1) or 1/0, which are left for evaluation to deal with, and for
+    results that can't be encoded, such as complex numbers, or ints that are too big"""
+
+    values = [constant.value for constant in constants]
+    if any(isinstance(value, np.ndarray) for value in values):
+        return None
+
+    # Python works out integer powers exactly, which takes a long time for big exponents,
+    # any int (other than 0, 1 and -1) to these powers is too big to encode anyway
+    if operation is Power.apply:
+        base, exponent = values
+        if (isinstance(base, int) and isinstance(exponent, int)
+                and abs(base) > 1 and exponent >= 8 * EncodingSettings.int_bytes):
+            return None
+
+    try:
+        with np.errstate(all="raise"):
+            value = operation(*values)
+    except (ArithmeticError, ValueError):
+        return None
+
+    # Fractional powers of negative numbers are complex in python, rather than an error
+    if isinstance(value, (complex, np.complexfloating)):
+        return None
+
+    if isinstance(value, int) and not (
+            EncodingSettings.min_encodable_signed_int <= value <= EncodingSettings.max_encodable_signed_int):
+        return None
+
+    # numpy functions give numpy scalars for python numbers, these can't be encoded
+    if isinstance(value, np.generic) and not any(isinstance(input_value, np.generic) for input_value in values):
+        value = value.item()
+
+    return Constant(value)
+
+
 class Unary(Expression):
     """ Base class for unary expression components"""
-    def __init__(self, a: Any):
-        self.a = Expression._sanitise(a)
+    __slots__ = ('a',)
+
+    def __new__(cls, a: Any):
+        # Inputs are nearly always expressions already (e.g. when differentiating), so check before calling _sanitise
+        if not isinstance(a, Expression):
+            a = Expression._sanitise(a)
+
+        if a.__class__ is Constant:
+            folded = _fold_constants(cls.apply, a)
+            if folded is not None:
+                return folded
+
+        node, created = cls._new_interned((cls, id(a)))
+        if created:
+            node.a = a
+            node._head_mask = cls._head_bit | a._head_mask
+            node._wildcard_numbers = a._wildcard_numbers
+        return node
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self.a})"
@@ -654,67 +1258,56 @@ class Unary(Expression):
     def wildcard_substitute(self, wildcard_id: int, expression: Expression):
         return self.__class__(self.a.wildcard_substitute(wildcard_id, expression))
 
-    def _pretty_print_lines(self, indent_str) -> List[str]:
-        a_lines = self.a._pretty_print_lines(indent_str)
-        a_lines = [indent_str + line for line in a_lines]
-        a_lines[-1] += ")"
-        return [f"{self.__class__.__name__}("] + a_lines
-
-
-    def _substitute(self, source_pattern: Expression, target_pattern: Expression) -> Expression:
-
-        new_a = self.a._substitute(source_pattern, target_pattern)
-
-        new_self = self.__class__(new_a)
-
-        match_data = source_pattern.match(new_self)
-
-        if match_data is not None:
-            replacement = target_pattern
-            for key in match_data:
-                replacement = replacement.wildcard_substitute(key, match_data[key])
+    def apply(self, a):
+        raise NotImplementedError(f"apply not implemented in {self.__class__.__name__}")
 
-            return replacement
+    def _cse(self, seen: Dict[int, Expression]) -> Expression:
+        out = seen.get(id(self))
+        if out is None:
+            out = self.__class__(self.a._cse(seen))
+            seen[id(self)] = out
 
-        else:
-            return new_self
+        return out
 
-    def full_identity(self, other: Expression) -> bool:
-        return self.head == other.head and self.a.full_identity(other.a)
+    def _flatten(self, seen: Dict[int, Expression]) -> Expression:
+        out = seen.get(id(self))
+        if out is None:
+            out = self.__class__(self.a._flatten(seen))
+            seen[id(self)] = out
 
-    def apply(self, a):
-        raise NotImplementedError(f"apply not implemented in {self.__class__.__name__}")
+        return out
 
     def __call__(self, x):
         return self.apply(self.a(x))
 
     def _reduce_constants(self):
-        return self.apply(self.a._reduce_constants())
+        return self.apply(self.a._memoised_reduce_constants())
 
     #
     # Serialisation
     #
 
     def _serialisation_details(self, variable_lookup: Dict[bytes, int]) -> bytes:
-        return self.a._serialise(variable_lookup)
+        return b''
 
 
     @staticmethod
-    def _create_from_bytes(
+    def _read_details(
             cls: Type[Unary],
-            data: bytes,
-            variable_lookup: List[Variable]) -> Tuple[Expression, int]:
+            data: memoryview,
+            offset: int,
+            variable_lookup: List[Variable]) -> Tuple[Any, int, int]:
 
-        a, length = Expression._deserialise_with_size(data, variable_lookup)
-
-        return cls(a), length
+        return None, 1, offset
 
 
 class NonDunderUnary(Unary):
     """ This is for Expressions based on functions from numpy etc, where the
     the call it makes isn't via python operations and a dunder"""
+    __slots__ = ()
+
     def _reduce_constants(self):
-        child = self.a._reduce_constants()
+        child = self.a._memoised_reduce_constants()
         if isinstance(child, Expression):
             return self.expr_apply(child)
         else:
@@ -727,9 +1320,29 @@ class NonDunderUnary(Unary):
 
 class Binary(Expression):
     """ Base class for binary expression components"""
-    def __init__(self, a: Any, b: Any):
-        self.a = Expression._sanitise(a)
-        self.b = Expression._sanitise(b)
+    __slots__ = ('a', 'b')
+
+    # Whether the operands can be swapped, used to put them in a canonical order
+    commutative = False
+
+    def __new__(cls, a: Any, b: Any):
+        if not isinstance(a, Expression):
+            a = Expression._sanitise(a)
+        if not isinstance(b, Expression):
+            b = Expression._sanitise(b)
+
+        if a.__class__ is Constant and b.__class__ is Constant:
+            folded = _fold_constants(cls.apply, a, b)
+            if folded is not None:
+                return folded
+
+        node, created = cls._new_interned((cls, id(a), id(b)))
+        if created:
+            node.a = a
+            node.b = b
+            node._head_mask = cls._head_bit | a._head_mask | b._head_mask
+            node._wildcard_numbers = a._wildcard_numbers | b._wildcard_numbers
+        return node
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self.a}, {self.b})"
@@ -743,78 +1356,276 @@ class Binary(Expression):
             self.a.wildcard_substitute(wildcard_id, expression),
             self.b.wildcard_substitute(wildcard_id, expression))
 
-    def _pretty_print_lines(self, indent_str) -> List[str]:
-        a_lines = self.a._pretty_print_lines(indent_str)
-        a_lines = [indent_str + line for line in a_lines]
-        a_lines[-1] += ","
-        b_lines = self.b._pretty_print_lines(indent_str)
-        b_lines = [indent_str + line for line in b_lines]
-        b_lines[-1] += ")"
+    @staticmethod
+    def apply(a, b):
+        raise NotImplementedError(f"apply not implemented in {__class__.__name__}")
 
-        return [f"{self.__class__.__name__}("] + a_lines + b_lines
+    def _cse(self, seen: Dict[int, Expression]) -> Expression:
+        out = seen.get(id(self))
+        if out is None:
+            a = self.a._cse(seen)
+            b = self.b._cse(seen)
+            if self.commutative and id(b) < id(a):
+                a, b = b, a
 
-    def _substitute(self, source_pattern: Expression, target_pattern: Expression) -> Expression:
+            out = self.__class__(a, b)
+            seen[id(self)] = out
 
-        new_a = self.a._substitute(source_pattern, target_pattern)
-        new_b = self.b._substitute(source_pattern, target_pattern)
+        return out
 
-        new_self = self.__class__(new_a, new_b)
+    def _flatten(self, seen: Dict[int, Expression]) -> Expression:
+        out = seen.get(id(self))
+        if out is None:
+            cls = _nary_equivalents.get(self.__class__, self.__class__)
+            out = cls(self.a._flatten(seen), self.b._flatten(seen))
+            seen[id(self)] = out
 
-        match_data = source_pattern.match(new_self)
+        return out
 
-        if match_data is not None:
-            replacement = target_pattern
-            for key in match_data:
-                replacement = replacement.wildcard_substitute(key, match_data[key])
+    def __call__(self, x):
+        return self.apply(self.a(x), self.b(x))
 
-            return replacement
+    def _reduce_constants(self):
+        return self.apply(self.a._memoised_reduce_constants(), self.b._memoised_reduce_constants())
 
-        else:
-            return new_self
+    def _serialisation_details(self, variable_lookup: Dict[Variable, int]) -> bytes:
+        return b''
 
-    def full_identity(self, other: Expression) -> bool:
-        return self.head == other.head and self.a.full_identity(other.a) and self.b.full_identity(other.b)
+    @staticmethod
+    def _read_details(
+            cls: Type[Binary],
+            data: memoryview,
+            offset: int,
+            variable_lookup: List[Variable]) -> Tuple[Any, int, int]:
+
+        return None, 2, offset
+
+
+def _canonical_key(expression: Expression) -> Tuple[str, str]:
+    """ Sort key for the operands of n-ary operations, short_string is kept on each node
+    and built without recursion, so this is cheap to get again for terms of a new node"""
+    return expression.head, expression.short_string()
+
+
+class Nary(Expression):
+    """ Base class for associative operations with any number of operands,
+    nested uses of the same operation (or its binary equivalent) are flattened into one node"""
+    __slots__ = ('_terms',)
+
+    # Binary version of the operation, absorbed into this one when flattening
+    binary: Type[Binary] = Binary
+
+    # Value of the operation with no operands
+    empty_value: Any = None
+
+    # Separator for the operands in short_string
+    operator_string = ", "
+
+    def __new__(cls, *args: Any):
+        terms = []
+        constant = None
+        stack = list(reversed(args))
+        while stack:
+            arg = Expression._sanitise(stack.pop())
+            if arg.__class__ is cls or arg.__class__ is cls.binary:
+                stack.extend(reversed(arg.terms))
+            elif isinstance(arg, Constant) and not isinstance(arg.value, np.ndarray):
+                # Numbers are combined into a single constant, as when folding binary operations
+                folded = arg if constant is None else _fold_constants(cls.apply, constant, arg)
+                if folded is None:
+                    terms.append(arg)
+                else:
+                    constant = folded
+            else:
+                terms.append(arg)
+
+        # Canonical order, so that, for example, Sum(a, b) and Sum(b, a) are the same node
+        terms.sort(key=_canonical_key)
+
+        if constant is not None:
+            if constant.value != cls.empty_value or len(terms) == 0:
+                terms.insert(0, constant)
+
+        if len(terms) == 0:
+            return Constant(cls.empty_value)
+
+        if len(terms) == 1:
+            return terms[0]
+
+        node, created = cls._new_interned((cls, ) + tuple(id(term) for term in terms))
+        if created:
+            node._terms = tuple(terms)
+            head_mask = cls._head_bit
+            wildcard_numbers = _no_wildcards
+            for term in terms:
+                head_mask |= term._head_mask
+                wildcard_numbers |= term._wildcard_numbers
+            node._head_mask = head_mask
+            node._wildcard_numbers = wildcard_numbers
+        return node
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({', '.join(repr(term) for term in self._terms)})"
+
+    @property
+    def terms(self) -> List[Expression]:
+        return list(self._terms)
+
+    def wildcard_substitute(self, wildcard_id: int, expression: Expression):
+        return self.__class__(*[term.wildcard_substitute(wildcard_id, expression) for term in self._terms])
+
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        parts: List[Union[str, Expression]] = ["("]
+        for term in self._terms:
+            parts += [term, self.operator_string]
+
+        parts[-1] = ")"
+
+        return parts
 
     @staticmethod
     def apply(a, b):
         raise NotImplementedError(f"apply not implemented in {__class__.__name__}")
 
+    def _cse(self, seen: Dict[int, Expression]) -> Expression:
+        out = seen.get(id(self))
+        if out is None:
+            # The new terms are put in canonical order by __new__, as for every Nary, so they are
+            # evaluated in that order, and the rounding can differ from the order they were written in
+            out = self.__class__(*[term._cse(seen) for term in self._terms])
+            seen[id(self)] = out
+
+        return out
+
+    def _flatten(self, seen: Dict[int, Expression]) -> Expression:
+        out = seen.get(id(self))
+        if out is None:
+            out = self.__class__(*[term._flatten(seen) for term in self._terms])
+            seen[id(self)] = out
+
+        return out
+
     def __call__(self, x):
-        return self.apply(self.a(x), self.b(x))
+        return reduce(self.apply, [term(x) for term in self._terms])
 
     def _reduce_constants(self):
-        return self.apply(self.a._reduce_constants(), self.b._reduce_constants())
+        reduced = [term._memoised_reduce_constants() for term in self._terms]
+        if any(isinstance(term, Expression) for term in reduced):
+            return self.__class__(*reduced)
+        else:
+            return reduce(self.apply, reduced)
 
-    def _serialisation_details(self, variable_lookup: Dict[Variable, int]) -> bytes:
-        return self.a._serialise(variable_lookup) + self.b._serialise(variable_lookup)
+    #
+    # Serialisation
+    #
+
+    def _serialisation_details(self, variable_lookup: Dict[bytes, int]) -> bytes:
+        return len(self._terms).to_bytes(
+            EncodingSettings.term_count_bytes,
+            EncodingSettings.endianness,
+            signed=False)
 
     @staticmethod
-    def _create_from_bytes(
-            cls: Type[Binary],
-            data: bytes,
-            variable_lookup: List[Variable]) -> Tuple[Expression, int]:
+    def _read_details(
+            cls: Type[Nary],
+            data: memoryview,
+            offset: int,
+            variable_lookup: List[Variable]) -> Tuple[Any, int, int]:
+
+        end = offset + EncodingSettings.term_count_bytes
+        count = int.from_bytes(
+            data[offset:end],
+            EncodingSettings.endianness,
+            signed=False)
+
+        return None, count, end
+
+
+#
+# Construction with simplification - used when differentiating so that
+# obviously reducible expressions (x*0, x+0, x^1 ...) are never built
+#
+
+
+def _is_number(expression: Expression, value) -> bool:
+    """ Check whether an expression is a (non-array) constant with a given value"""
+    return isinstance(expression, Constant) and \
+        not isinstance(expression.value, np.ndarray) and \
+        expression.value == value
+
+
+def _add(a: Expression, b: Expression) -> Expression:
+    if _is_number(a, 0):
+        return b
+    if _is_number(b, 0):
+        return a
+    if isinstance(a, Constant) and isinstance(b, Constant):
+        return Constant(a.value + b.value)
+    return Plus(a, b)
+
 
-        a, a_length = Expression._deserialise_with_size(data, variable_lookup)
-        b, b_length = Expression._deserialise_with_size(data[a_length:], variable_lookup)
+def _sub(a: Expression, b: Expression) -> Expression:
+    if _is_number(b, 0):
+        return a
+    if _is_number(a, 0):
+        return _neg(b)
+    if isinstance(a, Constant) and isinstance(b, Constant):
+        return Constant(a.value - b.value)
+    return Minus(a, b)
+
+
+def _neg(a: Expression) -> Expression:
+    if isinstance(a, Constant):
+        return Constant(-a.value)
+    if isinstance(a, Neg):
+        return a.a
+    return Neg(a)
+
+
+def _mul(a: Expression, b: Expression) -> Expression:
+    if _is_number(a, 0) or _is_number(b, 0):
+        return ZERO
+    if _is_number(a, 1):
+        return b
+    if _is_number(b, 1):
+        return a
+    if isinstance(a, Constant) and isinstance(b, Constant):
+        return Constant(a.value * b.value)
+    return Times(a, b)
+
+
+def _div(a: Expression, b: Expression) -> Expression:
+    if _is_number(a, 0):
+        return ZERO
+    if _is_number(b, 1):
+        return a
+    return Divide(a, b)
+
+
+def _pow(a: Expression, b: Expression) -> Expression:
+    if _is_number(b, 0):
+        return ONE
+    if _is_number(b, 1):
+        return a
+    return Power(a, b)
 
-        return cls(a, b), a_length + b_length
 
 #
 # Standard algabraic operations
 #
 
 class Plus(Binary):
-    def __init__(self, a: Expression, b: Expression):
-        super().__init__(a, b)
+    __slots__ = ()
+    commutative = True
 
-    def _diff(self, term: Variable):
-        return Plus(self.a._diff(term), self.b._diff(term))
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        return _add(self.a._memoised_diff(term, cache), self.b._memoised_diff(term, cache))
 
     def __call__(self, x):
         return self.a(x) + self.b(x)
 
-    def short_string(self):
-        return f"({self.a.short_string()} + {self.b.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["(", self.a, " + ", self.b, ")"]
 
     @staticmethod
     def apply(a, b):
@@ -822,14 +1633,13 @@ class Plus(Binary):
 
 
 class Minus(Binary):
-    def __init__(self, a: Expression, b: Expression):
-        super().__init__(a, b)
+    __slots__ = ()
 
-    def _diff(self, term: Variable):
-        return Minus(self.a._diff(term), self.b._diff(term))
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        return _sub(self.a._memoised_diff(term, cache), self.b._memoised_diff(term, cache))
 
-    def short_string(self):
-        return f"({self.a.short_string()} - {self.b.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["(", self.a, " - ", self.b, ")"]
 
     @staticmethod
     def apply(a, b):
@@ -837,14 +1647,13 @@ class Minus(Binary):
 
 
 class Neg(Unary):
-    def __init__(self, a: Expression):
-        super().__init__(a)
+    __slots__ = ()
 
-    def _diff(self, term: Variable):
-        return Neg(self.a._diff(term))
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        return _neg(self.a._memoised_diff(term, cache))
 
-    def short_string(self):
-        return f"-{self.a.short_string()}"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["-", self.a]
 
     @staticmethod
     def apply(a):
@@ -852,16 +1661,16 @@ class Neg(Unary):
 
 
 class Times(Binary):
-    def __init__(self, a: Expression, b: Expression):
-        super().__init__(a, b)
+    __slots__ = ()
+    commutative = True
 
-    def _diff(self, term: Variable):
-        return Plus(
-            Times(
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        return _add(
+            _mul(
                 self.a,
-                self.b._diff(term)),
-            Times(
-                self.a._diff(term),
+                self.b._memoised_diff(term, cache)),
+            _mul(
+                self.a._memoised_diff(term, cache),
                 self.b))
 
 
@@ -869,27 +1678,30 @@ class Times(Binary):
     def apply(a, b):
         return a * b
 
-    def short_string(self):
-        return f"({self.a.short_string()} * {self.b.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["(", self.a, " * ", self.b, ")"]
 
 
 class Divide(Binary):
-    def __init__(self, a: Expression, b: Expression):
-        super().__init__(a, b)
-
-    def _diff(self, term: Variable):
-        return Divide(
-            Minus(
-                Times(
-                    self.a._diff(term),
+    __slots__ = ()
+
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        if isinstance(self.b, Constant):
+            # Constant denominator: f' / g
+            return _div(self.a._memoised_diff(term, cache), self.b)
+
+        return _div(
+            _sub(
+                _mul(
+                    self.a._memoised_diff(term, cache),
                     self.b),
-                Times(
+                _mul(
                     self.a,
-                    self.b._diff(term))),
-            Power(self.b, Constant(2)))
+                    self.b._memoised_diff(term, cache))),
+            Power(self.b, TWO))
 
-    def short_string(self):
-        return f"({self.a.short_string()} / {self.b.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["(", self.a, " / ", self.b, ")"]
 
     @staticmethod
     def apply(a, b):
@@ -897,14 +1709,13 @@ class Divide(Binary):
 
 
 class Modulo(Binary):
-    def __init__(self, a: Expression, b: Expression):
-        super().__init__(a, b)
+    __slots__ = ()
 
-    def _diff(self, term: Variable):
-        return self.a._diff(term)
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        return self.a._memoised_diff(term, cache)
 
-    def short_string(self):
-        return f"({self.a.short_string()} % {self.b.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["(", self.a, " % ", self.b, ")"]
 
     @staticmethod
     def apply(a, b):
@@ -912,10 +1723,9 @@ class Modulo(Binary):
 
 
 class Power(Binary):
-    def __init__(self, a: Expression, b: Expression):
-        super().__init__(a, b)
+    __slots__ = ()
 
-    def _diff(self, term: Variable):
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
 
         """
         The general expression is
@@ -925,37 +1735,51 @@ class Power(Binary):
 
         f = self.a
         g = self.b
-        df = self.a._diff(term)
-        dg = self.b._diff(term)
+        df = self.a._memoised_diff(term, cache)
+
+        if isinstance(g, Constant):
+            # Constant exponent, no need for the log term: g f' f^(g-1)
+            return _mul(_mul(g, df), _pow(f, _sub(g, ONE)))
 
-        return Times(
-                Plus(
-                    Times(
-                        Times(f, dg),
+        dg = self.b._memoised_diff(term, cache)
+
+        if isinstance(f, Constant):
+            # Constant base, only the log term: g' log f f^g
+            return _mul(_mul(dg, Log(f)), self)
+
+        return _mul(
+                _add(
+                    _mul(
+                        _mul(f, dg),
                         Log(f)),
-                    Times(g, df)),
-                Power(
+                    _mul(g, df)),
+                _pow(
                     f,
-                    Minus(g, Constant(1))
+                    _sub(g, ONE)
                 )
             )
 
-    def short_string(self):
-        return f"({self.a.short_string()} ^ {self.b.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["(", self.a, " ^ ", self.b, ")"]
 
     @staticmethod
     def apply(a, b):
         return a ** b
 
 class Exp(NonDunderUnary):
-    def __init__(self, a: Expression):
-        super().__init__(a)
+    __slots__ = ()
+
+    def __new__(cls, a: Any):
+        # exp(log(x)) = x, wherever log(x) is defined
+        if isinstance(a, Log):
+            return a.a
+        return super().__new__(cls, a)
 
-    def _diff(self, term: Variable):
-        return Times(Exp(self.a), self.a._diff(term))
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        return _mul(self, self.a._memoised_diff(term, cache))
 
-    def short_string(self):
-        return f"exp({self.a.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["exp(", self.a, ")"]
 
     @staticmethod
     def apply(a):
@@ -967,14 +1791,19 @@ class Exp(NonDunderUnary):
 
 
 class Log(NonDunderUnary):
-    def __init__(self, a: Expression):
-        super().__init__(a)
+    __slots__ = ()
 
-    def _diff(self, term: Variable):
-        return Divide(self.a._diff(term), self.a)
+    def __new__(cls, a: Any):
+        # log(exp(x)) = x
+        if isinstance(a, Exp):
+            return a.a
+        return super().__new__(cls, a)
 
-    def short_string(self):
-        return f"log({self.a.short_string()})"
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        return _div(self.a._memoised_diff(term, cache), self.a)
+
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["log(", self.a, ")"]
 
     @staticmethod
     def apply(a):
@@ -985,19 +1814,92 @@ class Log(NonDunderUnary):
         return a.log
 
 
+#
+# Operations with any number of operands, made from chains of Plus and Times by Expression.flatten
+#
+
+class Sum(Nary):
+    __slots__ = ()
+    binary = Plus
+    empty_value = 0
+    operator_string = " + "
+
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        derivatives = [t._memoised_diff(term, cache) for t in self._terms]
+        return Sum(*[derivative for derivative in derivatives if not _is_number(derivative, 0)])
+
+    # Adding to a sum gives a longer sum, rather than a Plus with the sum in it
+
+    def __add__(self, other):
+        return Sum(self, Expression._sanitise(other, "+"))
+
+    def __radd__(self, other):
+        return Sum(Expression._sanitise(other, "+"), self)
+
+    @staticmethod
+    def apply(a, b):
+        return a + b
+
+
+class Product(Nary):
+    __slots__ = ()
+    binary = Times
+    empty_value = 1
+    operator_string = " * "
+
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        terms = self._terms
+        parts = []
+        for i, t in enumerate(terms):
+            derivative = t._memoised_diff(term, cache)
+            if _is_number(derivative, 0):
+                continue
+
+            others = terms[:i] + terms[i+1:]
+            if _is_number(derivative, 1):
+                parts.append(Product(*others))
+            else:
+                parts.append(Product(*others, derivative))
+
+        return Sum(*parts)
+
+    # Multiplying a product gives a longer product, rather than a Times with the product in it
+
+    def __mul__(self, other):
+        return Product(self, Expression._sanitise(other, "*"))
+
+    def __rmul__(self, other):
+        return Product(Expression._sanitise(other, "*"), self)
+
+    @staticmethod
+    def apply(a, b):
+        return a * b
+
+
+# n-ary operation that each binary one becomes when flattening
+_nary_equivalents: Dict[Type[Binary], Type[Nary]] = {cls.binary: cls for cls in (Sum, Product)}
+
+
 #
 # Some less nice operations that should none-the-less be supported
 #
 
 class Abs(Unary):
-    def __init__(self, a: Expression):
-        super().__init__(a)
+    __slots__ = ()
 
-    def _diff(self, term: Variable):
-        return Times(Sign(self.a), self.a._diff(term))
+    def __new__(cls, a: Any):
+        # abs(-x) = abs(abs(x)) = abs(x)
+        while isinstance(a, Neg):
+            a = a.a
+        if isinstance(a, Abs):
+            return a
+        return super().__new__(cls, a)
 
-    def short_string(self):
-        return f"abs({self.a.short_string()})"
+    def _diff(self, term: Variable, cache: Dict[int, Expression]):
+        return _mul(Sign(self.a), self.a._memoised_diff(term, cache))
+
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["abs(", self.a, ")"]
 
     @staticmethod
     def apply(a):
@@ -1005,11 +1907,16 @@ class Abs(Unary):
 
 
 class Sign(NonDunderUnary):
-    def __init__(self, a: Expression):
-        super().__init__(a)
+    __slots__ = ()
+
+    def __new__(cls, a: Any):
+        # sign(sign(x)) = sign(x)
+        if isinstance(a, Sign):
+            return a
+        return super().__new__(cls, a)
 
-    def short_string(self):
-        return f"sign({self.a.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["sign(", self.a, ")"]
 
     @staticmethod
     def apply(a):
@@ -1029,11 +1936,10 @@ class Sign(NonDunderUnary):
 
 
 class Cos(NonDunderUnary):
-    def __init__(self, a: Expression):
-        super().__init__(a)
+    __slots__ = ()
 
-    def short_string(self):
-        return f"cos({self.a.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["cos(", self.a, ")"]
 
     @staticmethod
     def apply(a):
@@ -1041,18 +1947,17 @@ class Cos(NonDunderUnary):
 
     @staticmethod
     def expr_apply(a: Expression):
-        return lambda x: Cos(x)
+        return Cos(a)
 
-    def _diff(self, term: Variable) -> Expression:
-        return -self.a.diff(term) * Sin(self.a)
+    def _diff(self, term: Variable, cache: Dict[int, Expression]) -> Expression:
+        return _neg(_mul(self.a._memoised_diff(term, cache), Sin(self.a)))
 
 
 class Sin(NonDunderUnary):
-    def __init__(self, a: Expression):
-        super().__init__(a)
+    __slots__ = ()
 
-    def short_string(self):
-        return f"sin({self.a.short_string()})"
+    def _short_string_parts(self) -> List[Union[str, Expression]]:
+        return ["sin(", self.a, ")"]
 
     @staticmethod
     def apply(a):
@@ -1060,11 +1965,11 @@ class Sin(NonDunderUnary):
 
     @staticmethod
     def expr_apply(a: Expression):
-        return lambda x: Sin(x)
+        return Sin(a)
 
 
-    def _diff(self, term: Variable) -> Expression:
-        return self.a.diff(term) * Cos(self.a)
+    def _diff(self, term: Variable, cache: Dict[int, Expression]) -> Expression:
+        return _mul(self.a._memoised_diff(term, cache), Cos(self.a))
 
 
 # Simplification rules:
@@ -1094,17 +1999,17 @@ simplification_substitutions: List[Tuple[Expression, Expression]] = [
     (w1 - 0,            w1), # Subtractive identity -> remove constant
     (w1 / 1,            w1), # Division identity -> remove constant
     (w1 ** 1,           w1), # Exponential identity -> remove constant
-    (0 * w1,            Constant(0)),  # Multiplication by zero -> remove zero constant and anything it multiplies
-    (w1 * 0,            Constant(0)),
-    (1 ** w1,           Constant(1)),  # Power rules, 1^x = 1
+    (0 * w1,            ZERO),  # Multiplication by zero -> remove zero constant and anything it multiplies
+    (w1 * 0,            ZERO),
+    (1 ** w1,           ONE),  # Power rules, 1^x = 1
     # (0 ** w1,           Constant(0)),  # 0^x = 0 (not quite true)
-    (w1 ** 0,           Constant(1)),  # x^0 = 1
+    (w1 ** 0,           ONE),  # x^0 = 1
     (w1 - (-w2),        w1+w2),        # Remove double minus -> remove minus signs
     (-(-(w1)),          w1),
     (w1 + (-w2),        w1 - w2),      # +- simplify -> reduce +- sign total
     ((-w1) + w2,        w2 - w1),
-    (Constant(1).log,   Constant(0)),  # Log 1 = 0 -> reduce number of logs
-    (Constant(0).exp,   Constant(1)),  # Exp 0 = 1 -> reduce exp number
+    # Log 1 = 0 and Exp 0 = 1 are done when the nodes are made (see _fold_constants),
+    # as patterns these would be constants, and would turn 0.0 and 1.0 into ints
     # (w1*w2 + w1*w3,     w1*(w2 + w3)),  # Distributivity of multiplication over addition
     # (w2*w1 + w1*w3,     w1*(w2 + w3)),
     # (w2*w1 + w3*w1,     w1*(w2 + w3)),
@@ -1120,6 +2025,13 @@ simplification_substitutions: List[Tuple[Expression, Expression]] = [
     (w1.log + w2.log,   (w1*w2).log),   # Log xply rule, reduce number of logs
 ]
 
+# Simplifications indexed by the class (head) of the source pattern, so that only
+# the rules that might apply to a node are tried (see Expression._rewrite)
+_simplification_rules: Dict[Type[Expression], List[Tuple[Expression, Expression]]] = defaultdict(list)
+for _source, _target in simplification_substitutions:
+    _simplification_rules[_source.__class__].append((_source, _target))
+
+
 #
 # Serialisation stuff
 #
@@ -1131,13 +2043,20 @@ def _encode_variable_table_entry(identity: bytes, alias: Optional[str]) -> bytes
     else:
         alias_bytes = encode_bytestring(alias.encode('utf-8'))
 
-    return encode_bytestring(identity) + alias_bytes
+    return b''.join((encode_bytestring(identity), alias_bytes))
+
+
+def _decode_variable_table_entry_with_size(data: memoryview, offset: int) -> Tuple[Tuple[bytes, Optional[str]], int]:
+    """ Decode an entry in the variable entry starting at `offset`, returns it with the offset after it"""
+    identity, identity_length = decode_bytestring_with_size(data[offset:])
+    offset += identity_length
 
+    alias_bytes, alias_length = decode_bytestring_with_size(data[offset:])
+    offset += alias_length
 
-def _decode_variable_table_entry_with_size(data: bytes) -> Tuple[Tuple[bytes, Optional[str]], int]:
-    """ Decode an entry in the variable entry """
-    identity, identity_length = decode_bytestring_with_size(data)
-    alias_bytes, alias_length = decode_bytestring_with_size(data[identity_length:])
+    # Slices of the view, copy them out of it
+    identity = bytes(identity)
+    alias_bytes = bytes(alias_bytes)
 
     if alias_length == EncodingSettings.bytestring_length_bytes:
         alias = None
@@ -1147,7 +2066,7 @@ def _decode_variable_table_entry_with_size(data: bytes) -> Tuple[Tuple[bytes, Op
         except UnicodeDecodeError as e:
             raise DecodingError(f"{str(e)} in alias for {str(identity)}: {str(alias_bytes)})")
 
-    return (identity, alias), identity_length + alias_length
+    return (identity, alias), offset
 
 def encode_variable_table(variables: List[Tuple[bytes, Optional[str]]]) -> bytes:
     """ Encode the the variable table """
@@ -1156,15 +2075,15 @@ def encode_variable_table(variables: List[Tuple[bytes, Optional[str]]]) -> bytes
     if n > EncodingSettings.variable_index_max:
         raise EncodingError(f"Too many variables for encoding {n}")
 
-    output_bytes = n.to_bytes(
+    parts = [n.to_bytes(
         EncodingSettings.variable_index_bytes,
         EncodingSettings.endianness,
-        signed=False)
+        signed=False)]
 
     for identity, alias in variables:
-        output_bytes += _encode_variable_table_entry(identity, alias)
+        parts.append(_encode_variable_table_entry(identity, alias))
 
-    return output_bytes
+    return b''.join(parts)
 
 
 def decode_variable_table_with_size(data: bytes) -> Tuple[List[Tuple[bytes, Optional[str]]], int]:
@@ -1175,14 +2094,16 @@ def decode_variable_table_with_size(data: bytes) -> Tuple[List[Tuple[bytes, Opti
         EncodingSettings.endianness,
         signed=False)
 
+    # Entries are read at an offset into a view of the data, rather than from copies of its tail
+    view = memoryview(data)
+
     table_data = []
-    start_index = EncodingSettings.variable_index_bytes
+    offset = EncodingSettings.variable_index_bytes
     for i in range(n_variables):
-        variable_data, length = _decode_variable_table_entry_with_size(data[start_index:])
+        variable_data, offset = _decode_variable_table_entry_with_size(view, offset)
         table_data.append(variable_data)
-        start_index += length
 
-    return table_data, start_index
+    return table_data, offset
 
 
 def decode_variable_table(data: bytes) -> List[Tuple[bytes, Optional[str]]]:
@@ -1206,6 +2127,8 @@ expression_encoding = {
     Sin: 13,
     Abs: 14,
     Sign: 15,
+    Sum: 16,
+    Product: 17,
 }
 
 expression_decoding = {
@@ -1,4 +1,4 @@
-from typing import List, Tuple, Union
+from typing import List, Tuple, Optional, Callable
 from expression import Expression
 import expression as expr
 import re
@@ -18,9 +18,9 @@ _token_res = {
     "right_paren": r"\)",
     # "comma":       r",",                    # Commas - required for binary functions
     "name":        r"[a-zA-Z][a-zA-Z0-9]*", # Character strings
-    "number":      r"[+-]?(\d+([.]\d*)?([eE][+-]?\d+)?|[.]\d+([eE][+-]?\d+)?)", # Numbers
+    "number":      r"(\d+([.]\d*)?([eE][+-]?\d+)?|[.]\d+([eE][+-]?\d+)?)", # Numbers (unsigned, see _tokenise for signs)
     "wildcard":    r"#[0-9]*",              # Wildcards
-    "op":          r"(\+|-|\*|/|\^|%)"        # Infix/postfix operators (note: lower priority than numbers, which might start with +/-)
+    "op":          r"(\+|-|\*|/|\^|%)"        # Infix/prefix operators
 }
 
 unary_functions = {
@@ -46,34 +46,61 @@ infix_operators_post_unary_minus = [
     ("+", expr.Plus)
 ]
 
+# Precedence of the infix operators, (higher binds more tightly), and of unary minus, which is between the two lists.
+# Each operator has its own level, so this gives the same grouping as applying the operators in the order above
+_unary_minus_precedence = len(infix_operators_post_unary_minus)
+
+_infix_operators = {
+    op_string: (precedence, op_cls)
+    for precedence, (op_string, op_cls) in enumerate(reversed(infix_operators_post_unary_minus))}
+
+_infix_operators.update({
+    op_string: (precedence, op_cls)
+    for precedence, (op_string, op_cls) in enumerate(
+        reversed(infix_operators_pre_unary_minus),
+        start=_unary_minus_precedence + 1)})
+
+# Prefix operators, + does nothing
+_prefix_operators = {
+    "-": expr.Neg,
+    "+": None
+}
+
+# All the token patterns in one, tried in the order above at each position, so that the whole string
+# is scanned by the regex engine, the kind of each token is the name of the group that matched
+_token_re = re.compile("|".join(f"(?P<{key}>{_token_res[key]})" for key in _token_res) + r"|(?P<whitespace>\s+)")
+
 def _tokenise(string: str) -> List[Tuple[str, str]]:
-    """ Split string into meaningful tokens"""
+    """ Split string into meaningful tokens
+
+    A sign written straight before a number, where an operand is expected (at the start, or after
+    an operator or parenthesis), is part of the number, so -2^2 is (-2)^2, but - 2^2 and x-2^2 are not"""
     tokens = []
-    while True:
+    position = 0
+    after_whitespace = False
+    for m in _token_re.finditer(string):
+        if m.start() != position:
+            break
 
-        match_success = False
+        position = m.end()
 
-        m = re.match(r"^\s+", string) # Match whitespace but don't include it
+        if m.lastgroup == "whitespace":
+            after_whitespace = True
+            continue
 
-        if m is None:
+        if (m.lastgroup == "number" and not after_whitespace
+                and tokens and tokens[-1][0] in _prefix_operators
+                and (len(tokens) == 1 or tokens[-2][1] in ("op", "left_paren"))):
+            tokens[-1] = (tokens[-1][0] + m[0], "number")
+        else:
+            tokens.append((m[0], m.lastgroup))
 
-            for key in _token_res:
-                m = re.match(r"^" + _token_res[key], string)
-                if m is not None:
-                    tokens.append((m[0], key))
-                    string = string[m.end(0):]
-                    match_success = True
-                    continue
+        after_whitespace = False
 
-        else:
-            string = string[m.end(0):]
-            match_success = True
+    if position != len(string):
+        raise ParseFailed(f"Could not find valid token starting at '{string[position:]}'")
 
-        if not match_success:
-            if len(string) > 0:
-                raise ParseFailed(f"Could not find valid token starting at '{string}'")
-            else:
-                return tokens
+    return tokens
 
 def _parse_constant(string: str) -> expr.Constant:
     try:
@@ -101,210 +128,117 @@ def _parse_wildcard(string: str) -> expr.Wildcard:
 
 
 def parse_expression(string: str) -> Expression:
-    tokens = _tokenise(string)
-
-    # check left and right parentheses match
-    count = 0
-    for token in tokens:
-        if token[1] == "left_paren":
-            count += 1
-        elif token[1] == "right_paren":
-            count -= 1
-            if count < 0:
-                raise SyntaxError("Unmatched parenthesis")
-
-    if count != 0:
-        raise SyntaxError("Unmatched parenthesis")
+    return _parse_tokens(_tokenise(string))
 
-    return _parse_tokens(tokens)
 
+def _parse_tokens(tokens: List[Tuple[str, str]]) -> Expression:
+    """ Build an expression from tokens in a single pass (shunting-yard), using a stack of operands
+    and a stack of operators waiting for them
 
-def _parse_tokens(tokens: List[Union[Tuple[str, str], Expression, Tuple[Expression, Expression]]]) -> Expression:
+    Entries in the operator stack are (precedence, class, is_prefix), or, for open parentheses,
+    (None, function, False), where function is the unary function being called, or None.
+    """
 
     if len(tokens) == 0:
         raise SyntaxError("Empty expression")
 
-    while True:
-
-        # Useful debugging statement
-        # print([t[0] if isinstance(t, tuple) else t for t in tokens])
-
-        # step one: find first innermost parentheses
-
-        start = 0
-        end = None
-        count = 0
-        for i, token in enumerate(tokens):
-            if isinstance(token, tuple):
-                if token[1] == "left_paren":
-                    start = i
-                    count += 1
-                elif token[1] == "right_paren":
-                    if count <= 0:
-                        raise SyntaxError("Unmatched parenthesis")
-                    end = i
-                    break
-
-        if end is not None:
-            # We got one!
-
-            left = tokens[:start]
-            middle = tokens[start+1:end]
-            right = tokens[end+1:]
-            # print(left, middle, right)
-
-            # Now, is the parenthesis part of a function call?
-            function_call = False
-            if len(left) > 0:
-                # check token type
-                if left[-1][1] == "name":
-                    # check for keyword
-                    # TODO: Add support for binary+ functions
-
-                    if left[-1][0] in unary_functions:
-                        ex = unary_functions[left[-1][0]]
-
-                        new_middle = ex(_parse_tokens(middle))
-
-                        tokens = left[:-1] + [new_middle] + right
-
-                    else:
-                        raise ParseFailed(f"Unknown function: '{left[-1][0]}'")
-
-                else:
-                    new_middle = _parse_tokens(middle)
-                    tokens = left + [new_middle] + right
-            else:
-                new_middle = _parse_tokens(middle)
-                tokens = left + [new_middle] + right
+    operands: List[Expression] = []
+    operators: List[Tuple[Optional[int], Optional[Callable], bool]] = []
 
+    def apply_operator():
+        _, op_cls, is_prefix = operators.pop()
+        if is_prefix:
+            if op_cls is not None:
+                operands.append(op_cls(operands.pop()))
         else:
-            # The pattern should be: (neg*) symbol infix (neg*) symbol infix (neg*) symbol ...
-            # First thing to do has to be to convert symbols to expression objects
-
-            new_tokens = []
-            for token in tokens:
-                if isinstance(token, tuple):
-                    if token[1] == "name":
-                        new_tokens.append(expr.Variable(token[0]))
-                    elif token[1] == "number":
-                        new_tokens.append(_parse_constant(token[0]))
-                    elif token[1] == "wildcard":
-                        new_tokens.append(_parse_wildcard(token[0]))
-                    elif token[1] == "op":
-                        new_tokens.append(token[0])
-                    else:
-                        raise ParseFailed(f"Unknown or misplaced token type '{token[1]}'")
-
-                elif isinstance(token, Expression):
-                    new_tokens.append(token)
-
-                else:
-                    raise RuntimeError(f"Token string contains element that is not an Expression or tuple: {token}")
-
-            tokens = new_tokens
-
-            # Next we apply all the of the operators that have a higher precedence than -
-
-            for op_string, op_cls in infix_operators_pre_unary_minus:
+            b = operands.pop()
+            a = operands.pop()
+            operands.append(op_cls(a, b))
 
-                while True:
+    def apply_operators(precedence: int):
+        """ Apply the operators waiting on the stack that bind at least as tightly as `precedence`"""
+        while operators and operators[-1][0] is not None and operators[-1][0] >= precedence:
+            apply_operator()
 
-                    for token_index, token in enumerate(tokens):
-                        if token == op_string:
-                            break
-                    else:
-                        break
+    expecting_operand = True
+    for index, (token_string, token_type) in enumerate(tokens):
 
-                    left = tokens[:token_index - 1]
-                    a = tokens[token_index - 1]
-                    b = tokens[token_index + 1]
-                    right = tokens[token_index + 2:]
+        if expecting_operand:
 
-                    if not isinstance(a, Expression):
-                        raise SyntaxError(f"Cannot apply {op_string} to {a}")
+            if token_type == "name":
+                next_is_paren = index + 1 < len(tokens) and tokens[index + 1][1] == "left_paren"
+                if next_is_paren:
+                    if token_string not in unary_functions:
+                        raise ParseFailed(f"Unknown function: '{token_string}'")
 
-                    if not isinstance(b, Expression):
-                        raise SyntaxError(f"Cannot apply {op_string} to {b}")
+                    # The function is applied when its parenthesis closes
+                    operators.append((None, unary_functions[token_string], False))
 
-                    tokens = left + [op_cls(a, b)] + right
-
-                    # print("Reduced:", tokens)
-
-            # Now to deal with the prefix operators
-
-            # group tokens into parts ending in an symbol,
-            # which should now be represented as an expression
+                else:
+                    operands.append(expr.Variable(token_string))
+                    expecting_operand = False
 
-            sections = []
-            this_section = []
-            for token in tokens:
-                this_section.append(token)
-                if isinstance(token, Expression):
-                    sections.append(this_section)
-                    this_section = []
+            elif token_type == "number":
+                operands.append(_parse_constant(token_string))
+                expecting_operand = False
 
-            if len(this_section) > 0:
-                raise SyntaxError("(sub)expression terminates with operator: ")
+            elif token_type == "wildcard":
+                operands.append(_parse_wildcard(token_string))
+                expecting_operand = False
 
-            # Now the rightmost value in section should be a symbol
-            #  and the leftmost value in all sections but the first should be an op
+            elif token_type == "left_paren":
+                # Parenthesis after a function name has already been added
+                if index == 0 or tokens[index - 1][1] != "name":
+                    operators.append((None, None, False))
 
-            # There should be at least one section, because we have checked for tokens
-            # Check the first section is of the form (neg*) symbol, we know it must end in
-            # a symbol because of the previous operation, just check everything before it is -
-            prefix_applied = sections[0][-1]
-            for token in sections[0][:-1]:
-                if token == "-":
-                    prefix_applied = expr.Neg(prefix_applied)
-                else:
-                    err_string = ' '.join([str(token) for token in tokens])
-                    raise SyntaxError(f"invalid prefix operator '{token}' in {err_string}")
+            elif token_type == "op":
+                if token_string not in _prefix_operators:
+                    raise SyntaxError(f"invalid prefix operator '{token_string}'")
 
-            new_tokens = [prefix_applied]
+                # A prefix operator straight after an infix one binds at least as tightly as it does,
+                # so that, for example, a^-b*c is (a^-b)*c, but -a*b is -(a*b)
+                precedence = _unary_minus_precedence
+                if operators and operators[-1][0] is not None:
+                    precedence = max(precedence, operators[-1][0])
 
-            for section in sections[1:]:
-                new_tokens.append(section[0])
-                prefix_applied = section[-1]
-                for token in section[1:-1]:
-                    if token == "-":
-                        prefix_applied = expr.Neg(prefix_applied)
-                    else:
-                        err_string = ' '.join([str(token) for token in tokens])
-                        raise SyntaxError(f"invalid prefix operator '{token}' in {err_string}")
+                operators.append((precedence, _prefix_operators[token_string], True))
 
-                new_tokens.append(prefix_applied)
+            elif token_type == "right_paren":
+                raise SyntaxError("(sub)expression terminates with operator, or is empty")
 
-            tokens = new_tokens
+            else:
+                raise ParseFailed(f"Unknown or misplaced token type '{token_type}'")
 
-            # tokens should now be of the form: symbol op symbol op ... op symbol
-            # go through each type of operator and apply it until there is none left
-            for op_string, op_cls in infix_operators_post_unary_minus:
+        else:
 
-                while True:
+            if token_type == "op":
+                precedence, op_cls = _infix_operators[token_string]
+                apply_operators(precedence)
+                operators.append((precedence, op_cls, False))
+                expecting_operand = True
 
-                    for token_index, token in enumerate(tokens):
-                        if token == op_string:
-                            break
-                    else:
-                        break
+            elif token_type == "right_paren":
+                apply_operators(-1)
 
-                    left = tokens[:token_index-1]
-                    a = tokens[token_index-1]
-                    b = tokens[token_index+1]
-                    right = tokens[token_index+2:]
+                if not operators:
+                    raise SyntaxError("Unmatched parenthesis")
 
-                    tokens = left + [op_cls(a, b)] + right
+                _, function, _ = operators.pop()
+                if function is not None:
+                    operands.append(function(operands.pop()))
 
+            else:
+                raise SyntaxError(f"Expected an operator, not '{token_string}'")
 
-                    # print("Reduced:", tokens)
+    if expecting_operand:
+        raise SyntaxError("(sub)expression terminates with operator")
 
-        # print("Before break test", tokens)
-        if len(tokens) == 1:
-            break
+    apply_operators(-1)
 
+    if operators:
+        raise SyntaxError("Unmatched parenthesis")
 
-    return tokens[0]
+    return operands[0]
 
 
 def tokeniser_proto_test():
@@ -0,0 +1,168 @@
+""" Simplified expressions kept on disk
+
+Simplification is deterministic, but can be slow for large expressions. Here, the results are
+kept in files named by a hash of the serialised expression (along with the number of iterations),
+so that the same expression is only simplified once, even across separate runs. The hash also
+includes the simplification rules and a version number, so results from an older version are
+not used.
+
+The number of files is limited by `max_entries`, when there are more than this, those that have
+been used least recently are removed (down to nine tenths of `max_entries`, so that this doesn't
+happen on every new entry). Entries older than `max_age_seconds` are ignored (and removed).
+
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from encoding import EncodingError, DecodingError
+from data_type_encoding import NoNumberEncoding
+from expression import Expression, NoEncodingEntry, simplification_substitutions
+
+logger = logging.getLogger("simplification_cache")
+
+# Change when simplification gives different results in ways the rules don't show
+# (e.g. changes to what is done when nodes are made)
+cache_version = 1
+
+# Included in every key, so that entries are only used with the same rules and version
+_key_salt = hashlib.blake2b(
+    "".join(f"{source.short_string()} -> {target.short_string()}\n"
+            for source, target in simplification_substitutions).encode("utf-8")
+    + cache_version.to_bytes(4, "big", signed=False),
+    digest_size=32).digest()
+
+
+def default_cache_directory() -> str:
+    return os.path.join(os.path.expanduser("~"), ".cache", "erroneous", "simplify")
+
+
+class SimplificationCache:
+    """ Simplify expressions, keeping the results on disk """
+
+    def __init__(self,
+                 directory: Optional[str] = None,
+                 max_entries: int = 10000,
+                 max_age_seconds: Optional[float] = None):
+
+        self.directory = default_cache_directory() if directory is None else directory
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Number of entries, found when it's first needed, then kept up to date in _store
+        self._entry_count: Optional[int] = None
+
+    def _key(self, expression: Expression, max_iters: int) -> Optional[str]:
+        """ File name for an expression, or None if it can't be serialised (e.g. it has wildcards)"""
+        try:
+            data = expression.serialise()
+        except (NoEncodingEntry, NoNumberEncoding, EncodingError):
+            return None
+
+        data += max_iters.to_bytes(4, "big", signed=False) + _key_salt
+
+        return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+    def _load(self, path: str) -> Optional[Expression]:
+        try:
+            if self.max_age_seconds is not None and time.time() - os.path.getmtime(path) > self.max_age_seconds:
+                os.remove(path)
+                return None
+
+            with open(path, 'rb') as file:
+                data = file.read()
+
+            simplified = Expression.deserialise(data)
+
+        except FileNotFoundError:
+            return None
+
+        except (DecodingError, KeyError, ValueError, IndexError) as e:
+            logger.warning(f"Could not read cached simplification {path} ({e}), removing it")
+            os.remove(path)
+            return None
+
+        # Mark as recently used, unless it has just been removed by another process
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return simplified
+
+    def _store(self, path: str, simplified: Expression):
+        try:
+            data = simplified.serialise()
+        except (NoEncodingEntry, NoNumberEncoding, EncodingError):
+            return
+
+        # Write to a temporary file first, so a partially written entry is never read
+        handle, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, 'wb') as file:
+            file.write(data)
+
+        if self._entry_count is None:
+            self._entry_count = self._count_entries()
+
+        if not os.path.exists(path):
+            self._entry_count += 1
+
+        os.replace(temp_path, path)
+
+        if self._entry_count > self.max_entries:
+            self._prune()
+
+    def _count_entries(self) -> int:
+        return sum(1 for entry in os.scandir(self.directory) if entry.is_file())
+
+    def _prune(self):
+        """ Remove the least recently used entries, leaving nine tenths of max_entries"""
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+
+        keep = self.max_entries - self.max_entries // 10
+
+        if len(entries) > keep:
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+
+            for entry in entries[:len(entries) - keep]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+        # Other processes might have added or removed entries too
+        self._entry_count = min(len(entries), keep)
+
+    def simplify(self, expression: Expression, max_iters: int = 100) -> Expression:
+        """ Same as expression.simplify(max_iters), but using the results on disk where possible"""
+
+        key = self._key(expression, max_iters)
+        if key is None:
+            return expression.simplify(max_iters)
+
+        path = os.path.join(self.directory, key)
+
+        simplified = self._load(path)
+
+        if simplified is None:
+            simplified = expression.simplify(max_iters)
+            self._store(path, simplified)
+
+        return simplified
+
+    def clear(self):
+        """ Remove all entries """
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                os.remove(entry.path)
+
+        self._entry_count = 0
@@ -0,0 +1,246 @@
+""" Optional SymEngine backend
+
+Differentiation and simplification of Expressions are done in python, node by node. SymEngine
+does the same things in C++, which is much faster for large expressions. Here, expressions are
+converted to SymEngine objects, the work is done there, and the result is converted back, so the
+Expression classes stay as they are. If SymEngine isn't installed, the functions here fall back
+to the Expression methods.
+
+Variables become SymEngine symbols named in the order they are found in the expression,
+as identities are bytes, and may not be valid symbol names. There is one symbol for each identity,
+so variables that differ only in their print alias are the same symbol, as they are when evaluating.
+
+SymEngine has no equivalent of Modulo, so expressions containing it can't be converted.
+
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Any, Callable, List, Tuple
+
+from fractions import Fraction
+from weakref import WeakKeyDictionary
+
+import numpy as np
+
+try:
+    import symengine
+except ImportError:
+    symengine = None
+
+import expression as expr
+from expression import Expression, Variable, EvaluationError
+
+
+# Conversions for each expression class, taking the converted terms
+_to_symengine_operations: Dict[type, Callable[..., Any]] = {} if symengine is None else {
+    expr.Plus: lambda a, b: symengine.Add(a, b),
+    expr.Minus: lambda a, b: symengine.Add(a, symengine.Mul(-1, b)),
+    expr.Neg: lambda a: symengine.Mul(-1, a),
+    expr.Times: lambda a, b: symengine.Mul(a, b),
+    expr.Divide: lambda a, b: symengine.Mul(a, symengine.Pow(b, -1)),
+    expr.Power: lambda a, b: symengine.Pow(a, b),
+    expr.Exp: symengine.exp,
+    expr.Log: symengine.log,
+    expr.Abs: symengine.Abs,
+    expr.Sign: symengine.sign,
+    expr.Cos: symengine.cos,
+    expr.Sin: symengine.sin,
+    expr.Sum: lambda *terms: symengine.Add(*terms),
+    expr.Product: lambda *terms: symengine.Mul(*terms)}
+
+
+def _check_available():
+    if symengine is None:
+        raise EvaluationError("symengine is required for the symengine backend")
+
+
+def _constant_to_symengine(value: Any):
+    if isinstance(value, np.ndarray):
+        raise EvaluationError("Array constants cannot be converted to symengine")
+
+    if isinstance(value, Fraction):
+        return symengine.Rational(value.numerator, value.denominator)
+
+    if isinstance(value, (int, np.integer)):
+        return symengine.Integer(int(value))
+
+    return symengine.RealDouble(float(value))
+
+
+def to_symengine(expression: Expression) -> Tuple[Any, Dict[Any, Variable]]:
+    """ Convert an expression to a SymEngine object, returns the converted expression
+    and the Variable for each symbol in it"""
+
+    _check_available()
+
+    symbols: Dict[bytes, Any] = {}
+    variables: Dict[Any, Variable] = {}
+    converted: Dict[int, Any] = {}
+
+    # Post-order over the (shared) nodes, so every node's terms are converted before it is
+    stack: List[Tuple[Expression, bool]] = [(expression, False)]
+    while stack:
+        node, terms_done = stack.pop()
+        if id(node) in converted:
+            continue
+
+        if isinstance(node, expr.Constant):
+            converted[id(node)] = _constant_to_symengine(node.value)
+
+        elif isinstance(node, Variable):
+            symbol = symbols.get(node.identity)
+            if symbol is None:
+                symbol = symengine.Symbol(f"v{len(symbols)}")
+                symbols[node.identity] = symbol
+                variables[symbol] = node
+            converted[id(node)] = symbol
+
+        elif terms_done:
+            operation = _to_symengine_operations.get(node.__class__)
+            if operation is None:
+                raise EvaluationError(f"No symengine equivalent for {node.__class__.__name__}")
+
+            converted[id(node)] = operation(*[converted[id(term)] for term in node.terms])
+
+        else:
+            stack.append((node, True))
+            stack.extend((term, False) for term in node.terms)
+
+    return converted[id(expression)], variables
+
+
+def from_symengine(basic: Any, variables: Dict[Any, Variable]) -> Expression:
+    """ Convert a SymEngine object back to an expression, `variables` is the Variable for each symbol,
+    as returned by `to_symengine`"""
+
+    _check_available()
+
+    converted: Dict[Any, Expression] = {}
+
+    stack: List[Tuple[Any, bool]] = [(basic, False)]
+    while stack:
+        node, args_done = stack.pop()
+        if node in converted:
+            continue
+
+        if node.is_Symbol:
+            converted[node] = variables[node]
+
+        elif node.is_Integer:
+            converted[node] = expr.Constant(int(node))
+
+        elif node.is_Rational:
+            numerator, denominator = node.get_num_den()
+            converted[node] = expr.Constant(Fraction(int(numerator), int(denominator)))
+
+        elif node.is_Number:
+            converted[node] = expr.Constant(float(node))
+
+        elif node == symengine.E:
+            converted[node] = expr.Exp(expr.ONE)
+
+        elif args_done:
+            converted[node] = _from_symengine_node(node, [converted[arg] for arg in node.args])
+
+        else:
+            stack.append((node, True))
+            stack.extend((arg, False) for arg in node.args)
+
+    return converted[basic]
+
+
+# Expression class for each SymEngine function, by lower case class name
+_from_symengine_functions: Dict[str, type] = {
+    "log": expr.Log,
+    "abs": expr.Abs,
+    "sign": expr.Sign,
+    "cos": expr.Cos,
+    "sin": expr.Sin}
+
+
+def _from_symengine_node(node: Any, args: List[Expression]) -> Expression:
+    if isinstance(node, symengine.Add):
+        return expr.Sum(*args)
+    elif isinstance(node, symengine.Mul):
+        return expr.Product(*args)
+    elif isinstance(node, symengine.Pow):
+        # exp(x) is E**x in symengine
+        if node.args[0] == symengine.E:
+            return expr.Exp(args[1])
+        return expr.Power(args[0], args[1])
+
+    cls = _from_symengine_functions.get(type(node).__name__.lower())
+    if cls is None:
+        raise EvaluationError(f"No expression equivalent for symengine object {node}")
+
+    return cls(*args)
+
+
+def diff(expression: Expression, term: Variable) -> Expression:
+    """ Differentiate with SymEngine, or with Expression.diff if it isn't installed"""
+    if symengine is None:
+        return expression.diff(term)
+
+    basic, variables = to_symengine(expression)
+    symbols = {variable.identity: symbol for symbol, variable in variables.items()}
+
+    if term.identity not in symbols:
+        return expr.ZERO
+
+    return from_symengine(basic.diff(symbols[term.identity]), variables)
+
+
+def simplify(expression: Expression) -> Expression:
+    """ Simplify with SymEngine (by expanding), or with Expression.simplify if it isn't installed"""
+    if symengine is None:
+        return expression.simplify()
+
+    basic, variables = to_symengine(expression)
+    return from_symengine(symengine.expand(basic), variables)
+
+
+class SymEngineFunction:
+    """ An expression compiled by SymEngine's Lambdify, called with a variable map
+    in the same way as an Expression"""
+
+    def __init__(self, expression: Expression):
+        basic, variables = to_symengine(expression)
+        symbols = list(variables)
+
+        self.variables = [variables[symbol].identity for symbol in symbols]
+
+        try:
+            self.kernel = symengine.Lambdify(symbols, [basic], backend="llvm")
+        except (ValueError, RuntimeError):
+            # SymEngine built without LLVM
+            self.kernel = symengine.Lambdify(symbols, [basic])
+
+    def __call__(self, variable_map: Dict[bytes, Any]):
+        values = np.broadcast_arrays(*[np.asarray(variable_map[variable], dtype=float) for variable in self.variables])
+        shape = values[0].shape if values else ()
+
+        result = np.asarray(self.kernel(np.stack(values, axis=-1) if values else np.empty(0)))
+
+        if shape == ():
+            return float(result.reshape(-1)[0])
+        else:
+            return result.reshape(shape)
+
+
+# Kept for as long as the expression is
+_functions: WeakKeyDictionary[Expression, Callable] = WeakKeyDictionary()
+
+
+def function(expression: Expression) -> Callable:
+    """ The expression as a function of a variable map, compiled by SymEngine if it is installed,
+    otherwise this is Expression.function. Functions are kept, so each expression is only compiled once"""
+    if symengine is None:
+        return expression.function()
+
+    compiled = _functions.get(expression)
+    if compiled is None:
+        compiled = SymEngineFunction(expression)
+        _functions[expression] = compiled
+
+    return compiled
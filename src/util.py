@@ -1,3 +1,6 @@
+import warnings
+
+
 class Recurse(Exception):
     """ Exception used to convert tail recursion to loop """
     def __init__(self, *args, **kwargs):
@@ -11,7 +14,16 @@ def recurse(*args, **kwargs):
 
 
 def tail_recursive(fun):
-    """ Make a tail recursive function"""
+    """ Make a tail recursive function
+
+    Deprecated: each call through `recurse` raises and catches an exception, which is much slower than
+    a plain loop, write the function with a `while` loop instead (as is done throughout expression.py)
+    """
+    warnings.warn(
+        "tail_recursive is deprecated, use a loop instead",
+        DeprecationWarning,
+        stacklevel=2)
+
     def decorated(*args, **kwargs):
         while True:
             try:
@@ -0,0 +1,25 @@
+""" pytest configuration
+
+Hypothesis profiles, chosen with the HYPOTHESIS_PROFILE environment variable, e.g.
+
+    HYPOTHESIS_PROFILE=ci pytest -n auto ../test
+    HYPOTHESIS_PROFILE=dev pytest ../test
+
+The tests don't share any state, so they can be spread over processes with pytest-xdist (if installed)
+"""
+
+import os
+
+from hypothesis import settings, Phase
+
+# Same examples on every run, so that CI results (from any number of workers) are reproducible,
+# and no deadlines, as timings on shared machines aren't reliable
+settings.register_profile("ci", derandomize=True, deadline=None)
+
+# For quick local runs, failures are reported as found, without shrinking them first
+settings.register_profile(
+    "dev",
+    phases=[Phase.explicit, Phase.reuse, Phase.generate, Phase.target],
+    deadline=None)
+
+settings.load_profile(os.environ.get("HYPOTHESIS_PROFILE", "default"))
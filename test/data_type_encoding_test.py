@@ -1,6 +1,7 @@
+import math
 import numpy as np
 import unittest
-from hypothesis import given, strategies as st
+from hypothesis import given, settings, strategies as st
 from typing import Union, List
 
 from encoding import EncodingSettings, EncodingError
@@ -12,11 +13,32 @@ from data_type_encoding import (
     encode_bytestring, decode_bytestring_with_size)
 
 
+# Python numbers that can be encoded, used by several tests
+_scalars = st.one_of(
+    st.floats(),
+    st.integers(
+        min_value=-(2**31 - 1),
+        max_value=2**31 - 1))
+
+
+def _same_number(a: Union[int, float], b: Union[int, float]) -> bool:
+    """ Equality of python numbers, where nans are equal, but 0.0 and -0.0 are not (like np.testing.assert_equal)"""
+    if isinstance(a, float):
+        if math.isnan(a):
+            return math.isnan(b)
+
+        return a == b and math.copysign(1.0, a) == math.copysign(1.0, b)
+
+    return a == b
+
+
 class TestDataTypeEncoding(unittest.TestCase):
 
+    @settings(max_examples=40, deadline=None)
+    # The length limit (4GB) is far beyond anything drawn here, so the sizes are just kept small
     @given(
-        data=st.binary(),
-        padding=st.binary())
+        data=st.binary(max_size=4096),
+        padding=st.binary(max_size=128))
 
     def test_encode_decode_bytes(self, data: bytes, padding: bytes):
         n = len(data)
@@ -33,49 +55,109 @@ class TestDataTypeEncoding(unittest.TestCase):
             self.assertEqual(decoded_length, n + EncodingSettings.bytestring_length_bytes)
 
 
+    @settings(max_examples=75, deadline=None)
+    @given(
+        st.lists(
+            _scalars,
+            min_size=1,
+            max_size=256))
+
+    def test_encode_decode_scalar(self, data: List[Union[float, int]]):
+
+        # Several scalars per example, so the time goes on encoding rather than generating examples
+        decoded = [decode_numeric(encode_numeric(number)) for number in data]
+
+        self.assertEqual(list(map(type, data)), list(map(type, decoded)))
+        self.assertEqual([(a, b) for a, b in zip(data, decoded) if not _same_number(a, b)], [])
+
     @given(
         st.one_of(
-            st.floats(),
+            st.floats(width=32).map(np.float32),
             st.integers(
                 min_value=-(2**31 - 1),
-                max_value=2**31 - 1)))
+                max_value=2**31 - 1).map(np.int64)))
 
-    def test_encode_decode_scalar(self, data: Union[float, int, np.ndarray]):
+    def test_encode_decode_numpy_scalar(self, data: Union[np.floating, np.integer]):
 
-        encoded = encode_numeric(data)
-        decoded = decode_numeric(encoded)
+        decoded = decode_numeric(encode_numeric(data))
 
-        self.assertEqual(type(data), type(decoded))
+        # Decoded as the python number of the same kind
+        self.assertEqual(type(decoded), float if isinstance(data, np.floating) else int)
         np.testing.assert_equal(data, decoded)
 
+    def _check_roundtrip(self, data: np.ndarray):
+
+        encoded = encode_numeric(data)
+        decoded: np.ndarray = decode_numeric(encoded)
 
+        if len(data) == 1:
+
+            np.testing.assert_equal(data, decoded)
+
+        else:
+
+            self.assertEqual(data.dtype, decoded.dtype)
+            self.assertEqual(data.shape, decoded.shape)
+
+            # Encoding is lossless, so the values should be identical, bit for bit
+            self.assertEqual(data.tobytes(), decoded.tobytes())
+
+    @settings(max_examples=50, deadline=None)
+    @given(
+        arrays(
+            shape=array_shapes(max_dims=4, max_side=8),
+            dtype=EncodingSettings.int_dtype))
+
+    def test_encode_decode_numpy_int(self, data: np.ndarray):
+        self._check_roundtrip(data)
+
+    @settings(max_examples=50, deadline=None)
+    @given(
+        arrays(
+            shape=array_shapes(max_dims=4, max_side=8),
+            dtype=EncodingSettings.float_dtype,
+            elements=st.floats(allow_nan=True, allow_infinity=True)))
+
+    def test_encode_decode_numpy_float(self, data: np.ndarray):
+        self._check_roundtrip(data)
 
     @given(
         st.one_of(
+            _scalars,
             arrays(
-                shape=array_shapes(max_dims=4),
+                shape=array_shapes(max_dims=4, min_side=0),
                 dtype=EncodingSettings.int_dtype),
             arrays(
-                shape=array_shapes(max_dims=4),
+                shape=array_shapes(max_dims=4, min_side=0),
                 dtype=EncodingSettings.float_dtype)))
 
-    def test_encode_decode_numpy(self, data: np.ndarray):
+    def test_encode_decode_narrow_precision(self, data: Union[float, int, np.ndarray]):
 
+        EncodingSettings.allow_narrow_precision = True
+        try:
             encoded = encode_numeric(data)
-            decoded: np.ndarray = decode_numeric(encoded)
+            decoded = decode_numeric(encoded)
+        finally:
+            EncodingSettings.allow_narrow_precision = False
 
-            if len(data) == 1:
+        # Values are never lost, and are decoded to the usual types
+        self.assertEqual(type(data), type(decoded))
+        if isinstance(data, np.ndarray):
+            self.assertEqual(data.dtype, decoded.dtype)
+            self.assertEqual(data.shape, decoded.shape)
 
-                np.testing.assert_equal(data, decoded)
+        np.testing.assert_equal(data, decoded)
 
-            else:
+    def test_narrow_precision_size(self):
+        data = np.arange(100, dtype=EncodingSettings.int_dtype)
 
-                self.assertEqual(data.dtype, decoded.dtype)
-                self.assertEqual(len(data.shape), len(decoded.shape))
-                for n, m in zip(data.shape, decoded.shape):
-                    self.assertEqual(n, m)
+        EncodingSettings.allow_narrow_precision = True
+        try:
+            encoded = encode_numeric(data)
+        finally:
+            EncodingSettings.allow_narrow_precision = False
 
-                np.testing.assert_almost_equal(data, decoded)
+        self.assertLess(len(encoded), len(encode_numeric(data)) // 2)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import numpy as np
+import unittest
+from typing import List
+from hypothesis import given, settings, strategies as st
+
+from hypothesis.extra.numpy import arrays
+
+from expression import Expression, Variable
+from parsing import parse_expression
+from evaluation import numba
+
+
+class TestCompiledEvaluation(unittest.TestCase):
+
+    test_expressions = [
+        parse_expression("x"),
+        parse_expression("x^2 + 1"),
+        parse_expression("x*y - y/x"),
+        parse_expression("exp(x) * log(abs(y) + 1)"),
+        parse_expression("cos(x)^2 + sin(x)^2 - sign(y)"),
+        parse_expression("(x + y) * (x + y) % 3"),
+        parse_expression("-x + --(y-x)^(x^2)"),
+        parse_expression("x^3 + 2*x").fast_diff(Variable("x")),
+        parse_expression("2^(x*y) + x/3").fast_diff(Variable("x")),
+        parse_expression("x*y*x + 2*x + 3 + x^2*y").flatten(),
+        parse_expression("x*y*x + 2*x + 3 + x^2*y").flatten().fast_diff(Variable("x")),
+        2 * parse_expression("x + y").flatten() * Variable("y") + Variable("x") - 1
+    ]
+
+    def test_flatten_keeps_value(self):
+        # Multiplying by zero isn't simplified away, log(-1) is nan, so the sum is too
+        expression = parse_expression("x + 0*log(y)")
+        variables = {b"x": 1.0, b"y": -1.0}
+
+        with np.errstate(invalid="ignore"):
+            np.testing.assert_equal(expression.flatten()(variables), expression(variables))
+
+    @given(
+        x=st.floats(min_value=0.1, max_value=10),
+        y=st.floats(min_value=-10, max_value=10))
+
+    def test_compiled_scalar(self, x: float, y: float):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            np.testing.assert_equal(expression.compile()(variables), expression(variables))
+
+    @given(
+        x=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=0.1, max_value=10)),
+        y=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=-10, max_value=10)))
+
+    def test_compiled_array(self, x: np.ndarray, y: np.ndarray):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            np.testing.assert_equal(expression.compile()(variables), expression(variables))
+
+    @given(
+        x=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=0.1, max_value=10)),
+        y=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=-10, max_value=10)))
+
+    def test_function_array(self, x: np.ndarray, y: np.ndarray):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            np.testing.assert_equal(expression.function()(variables), expression(variables))
+
+    @given(
+        x=st.lists(st.floats(min_value=0.1, max_value=10), min_size=1, max_size=16),
+        y=st.floats(min_value=-10, max_value=10))
+
+    def test_batch_call(self, x: List[float], y: float):
+        for expression in self.test_expressions:
+            np.testing.assert_equal(
+                expression.batch_call({b"x": x, b"y": y}),
+                expression({b"x": np.array(x), b"y": y}))
+
+    @given(
+        x=arrays(shape=(4, 16), dtype=np.float32, elements=st.floats(min_value=0.125, max_value=10, width=32)),
+        y=st.floats(min_value=-10, max_value=10))
+
+    def test_compiled_mixed(self, x: np.ndarray, y: float):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            np.testing.assert_equal(expression.compile()(variables), expression(variables))
+
+    # Expressions without discontinuities or large values, for comparing results in different precisions
+    float32_expressions = [
+        parse_expression("x^2 + 1"),
+        parse_expression("x*y - y/x"),
+        parse_expression("exp(x) * log(abs(y) + 2)"),
+        parse_expression("cos(x)^2 + sin(x)^2"),
+        parse_expression("x*y*x + 2*x + 3 + x^2*y").flatten().fast_diff(Variable("x"))
+    ]
+
+    @given(
+        x=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=0.1, max_value=10)),
+        y=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=-10, max_value=10)))
+
+    def test_compiled_float32(self, x: np.ndarray, y: np.ndarray):
+        variables = {b"x": x, b"y": y}
+        for expression in self.float32_expressions:
+            result = expression.compile(dtype=np.float32)(variables)
+            self.assertEqual(result.dtype, np.float32)
+            np.testing.assert_allclose(result, expression(variables), rtol=1e-4, atol=1e-3)
+
+    @unittest.skipIf(numba is None, "numba not installed")
+    @settings(deadline=None)  # First example includes compilation time
+    @given(
+        x=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=0.1, max_value=10)),
+        y=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=-10, max_value=10)))
+
+    def test_jit_array(self, x: np.ndarray, y: np.ndarray):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            np.testing.assert_allclose(expression.jit()(variables), expression(variables))
+
+    @unittest.skipIf(numba is None, "numba not installed")
+    @settings(deadline=None)  # First example includes compilation time
+    @given(
+        x=arrays(shape=16, dtype=np.float64, elements=st.floats(min_value=0.1, max_value=10)),
+        y=st.floats(min_value=-10, max_value=10))
+
+    def test_jit_parallel(self, x: np.ndarray, y: float):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            np.testing.assert_allclose(expression.jit(parallel=True)(variables), expression(variables))
+
+
+if __name__ == "__main__":
+    unittest.main()
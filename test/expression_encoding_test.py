@@ -1,17 +1,28 @@
 import numpy as np
 import unittest
-from hypothesis import given, strategies as st
-from typing import Union, List, Optional, Tuple
+from hypothesis import given, settings, assume, strategies as st
+from hypothesis.stateful import RuleBasedStateMachine, Bundle, rule
+from typing import Union, List, Optional, Tuple, Dict
 
 from encoding import EncodingSettings, EncodingError
 
 from hypothesis.extra.numpy import arrays, array_shapes
 
-from expression import Expression, Constant, Variable, Plus, Neg
+from expression import Expression, Constant, Variable, Plus, Neg, Power
 from expression import encode_variable_table, decode_variable_table_with_size
 from parsing import parse_expression
 
 
+# Expressions with their encoding and printed form, worked out once
+_expression_fixtures = tuple(
+    (expression, expression.serialise(), expression.pretty_print_string())
+    for expression in [
+        parse_expression("x^2 + 1"),
+        parse_expression("a+b+c"),
+        parse_expression("10*(p+q)/(p-q)"),
+        parse_expression("a+b+c + 2*a*b*c").flatten()])
+
+
 class TestExpressionEncoding(unittest.TestCase):
 
     @given(
@@ -23,93 +34,98 @@ class TestExpressionEncoding(unittest.TestCase):
 
     def test_encode_decode_variable_table(self, data: List[Tuple[bytes, Optional[str]]], padding):
 
-        print(data)
-
         encoded = encode_variable_table(data)
         decoded, size = decode_variable_table_with_size(encoded + padding)
 
-        self.assertEqual(None, None)
+        self.assertEqual(len(encoded), size)
+        self.assertEqual(data, decoded)
 
-        self.assertEqual(len(data), len(decoded))
+    def test_encode_decode_expression(self):
+        for expression, encoded, pretty in _expression_fixtures:
+            decoded = Expression.deserialise(encoded)
 
-        for (a1, a2), (b1, b2) in zip(data, decoded):
-            self.assertEqual(a1, b1)
-            self.assertEqual(a2, b2)
+            self.assertIs(expression, decoded)
+            self.assertEqual(pretty, decoded.pretty_print_string())
 
-    @given(
-        data=st.one_of(
-            st.integers(
-                min_value=EncodingSettings.min_encodable_signed_int,
-                max_value=EncodingSettings.max_encodable_signed_int),
-            st.floats()),
-        padding=st.binary())
+    def test_encode_decode_unfolded_constants(self):
+        # Operations on constants are only folded when the result can be encoded
+        for expression in [
+                parse_expression("2^70"),
+                parse_expression("10^400"),
+                Constant(100000) * Constant(100000),
+                Constant(EncodingSettings.max_encodable_signed_int) + 1,
+                (Variable("x") + EncodingSettings.max_encodable_signed_int + 1).flatten(),
+                parse_expression("(-1)^0.5"),
+                parse_expression("(-8)^(1/3)")]:
 
-    def test_encode_decode_constant_no_table(self, data: Union[int, float], padding: bytes):
-        expr = Constant(data)
-        encoded = expr._serialise({}) + padding
-        decoded, _ = Expression._deserialise_with_size(encoded, [])
+            self.assertNotIsInstance(expression, Constant)
+            self.assertIs(expression, Expression.deserialise(expression.serialise()))
 
-        self.assertEqual(expr.pretty_print_string(), decoded.pretty_print_string())
+    def test_big_power_not_folded(self):
+        # This would take a long time to work out
+        self.assertIsInstance(parse_expression("2^(10^9)"), Power)
 
 
-    @given(
-        data=st.one_of(
-            st.integers(
-                min_value=EncodingSettings.min_encodable_signed_int,
-                max_value=EncodingSettings.max_encodable_signed_int),
-            st.floats()),
-        padding=st.binary())
+class ExpressionEncodingMachine(RuleBasedStateMachine):
+    """ Builds expressions up from constants and variables, checking that each new one
+    survives encoding and decoding (with padding after it), with and without a variable table"""
 
-    def test_encode_decode_constant(self, data: Union[int, float], padding: bytes):
-        expr = Constant(data)
-        encoded = expr.serialise() + padding
-        decoded = Expression.deserialise(encoded)
+    expressions = Bundle("expressions")
 
-        self.assertEqual(expr.pretty_print_string(), decoded.pretty_print_string())
+    def __init__(self):
+        super().__init__()
+        # Variables with the same identity share a print alias, as the variable table keeps only one
+        self.print_aliases: Dict[bytes, Optional[str]] = {}
 
+    def check_round_trip(self, expression: Expression, padding: bytes) -> Expression:
+        expected = expression.pretty_print_string()
 
-    @given(
+        encoded = expression.serialise()
+        decoded, size = Expression.deserialise_with_size(encoded + padding)
+
+        assert size == len(encoded)
+        assert decoded.pretty_print_string() == expected
+
+        if len(expression.variables()) == 0:
+            decoded, _ = Expression._deserialise_with_size(expression._serialise({}) + padding, [])
+            assert decoded.pretty_print_string() == expected
+
+        return expression
+
+    @rule(
+        target=expressions,
         data=st.one_of(
             st.integers(
                 min_value=EncodingSettings.min_encodable_signed_int,
                 max_value=EncodingSettings.max_encodable_signed_int),
             st.floats()),
         padding=st.binary())
+    def constant(self, data: Union[int, float], padding: bytes):
+        return self.check_round_trip(Constant(data), padding)
 
-    def test_encode_decode_neg_no_table(self, data: Union[int, float], padding: bytes):
-        expr = Neg(Constant(data))
-        encoded = expr._serialise({}) + padding
-        decoded, _ = Expression._deserialise_with_size(encoded, [])
-
-        self.assertEqual(expr.pretty_print_string(), decoded.pretty_print_string())
-
-
-    @given(
+    @rule(
+        target=expressions,
         identity=st.binary(min_size=1),
         print_alias=st.text(min_size=1) | st.none(),
         padding=st.binary())
-    def test_encode_decode_single_variable(self, identity: bytes, print_alias: Optional[str], padding: bytes):
-        expr = Variable(identity, print_alias=print_alias)
-        encoded = expr.serialise()
+    def variable(self, identity: bytes, print_alias: Optional[str], padding: bytes):
+        print_alias = self.print_aliases.setdefault(identity, print_alias)
+        return self.check_round_trip(Variable(identity, print_alias=print_alias), padding)
 
-        decoded, size = Expression.deserialise_with_size(encoded + padding)
+    @rule(target=expressions, a=expressions, padding=st.binary())
+    def neg(self, a: Expression, padding: bytes):
+        return self.check_round_trip(Neg(a), padding)
 
-        self.assertEqual(len(encoded), size)
-        self.assertEqual(expr.pretty_print_string(), decoded.pretty_print_string())
+    @rule(target=expressions, a=expressions, b=expressions, padding=st.binary())
+    def plus(self, a: Expression, b: Expression, padding: bytes):
+        # Terms can be shared, so sizes can double at every step, keep them small
+        assume(len(a.serialise()) + len(b.serialise()) < 4096)
+        return self.check_round_trip(Plus(a, b), padding)
 
 
-    test_expressions = [
-        parse_expression("x^2 + 1"),
-        parse_expression("a+b+c"),
-        parse_expression("10*(p+q)/(p-q)")
-    ]
-
-    def test_encode_decode_expression(self):
-        for expression in self.test_expressions:
-            encoded = expression.serialise()
-            decoded = Expression.deserialise(encoded)
+TestExpressionEncodingMachine = ExpressionEncodingMachine.TestCase
+TestExpressionEncodingMachine.settings = settings(max_examples=50, stateful_step_count=20, deadline=None)
 
-            self.assertEqual(expression.pretty_print_string(), decoded.pretty_print_string())
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,83 @@
+import unittest
+
+from expression import Variable, Wildcard
+from parsing import parse_expression
+
+
+class TestMatching(unittest.TestCase):
+
+    x = Variable("x")
+    y = Variable("y")
+
+    w1 = Wildcard(0)
+    w2 = Wildcard(1)
+    w3 = Wildcard(2)
+
+    def test_match(self):
+        match_data = (self.w1 + self.w2).match(parse_expression("x + y^2"))
+
+        self.assertIs(match_data[0], self.x)
+        self.assertIs(match_data[1], self.y ** 2)
+
+    def test_no_match(self):
+        self.assertIsNone((self.w1 * self.w2).match(parse_expression("x + y")))
+        self.assertIsNone((self.w1 + 0).match(parse_expression("x + 1")))
+
+    def test_repeated_wildcard(self):
+        pattern = self.w1**self.w2 * self.w1**self.w3
+
+        self.assertIsNotNone(pattern.match(parse_expression("x^2 * x^3")))
+        self.assertIsNone(pattern.match(parse_expression("x^2 * y^3")))
+
+    def test_repeated_wildcard_simplify(self):
+        self.assertIs(parse_expression("x^2 * x^3").simplify(), self.x ** 5)
+        self.assertIs(parse_expression("x^2 * y^3").simplify(), self.x**2 * self.y**3)
+
+    def test_repeated_wildcard_print_alias(self):
+        # The same variable, whatever it is printed as
+        aliased = Variable("x", print_alias="X")
+        pattern = self.w1**self.w2 * self.w1**self.w3
+
+        self.assertIsNotNone(pattern.match(self.x**2 * aliased**3))
+        self.assertIs((self.x**2 * aliased**3).simplify(), self.x ** 5)
+
+    def test_substitute(self):
+        expression = parse_expression("sin(x * y) + 1")
+        replaced = expression.substitute(self.w1 * self.w2, self.w2 ** self.w1 + self.w2)
+
+        self.assertIs(replaced, parse_expression("sin(y^x + y) + 1"))
+
+    def test_deep_substitute(self):
+        # Deeper than the recursion limit
+        expression = self.x
+        target = self.x
+        for i in range(5000):
+            expression = (expression + self.y) * 2
+            target = (target + self.y) * 3
+
+        self.assertIs(expression.substitute(self.w1 * 2, self.w1 * 3), target)
+
+    def test_simplify_keeps_value(self):
+        # Replacements are temporary nodes, rewriting mustn't confuse them with later nodes
+        z = Variable("z")
+        self.assertIs(((-z - -z) + (-self.x + self.y)).simplify(), (z - z) + (self.y - self.x))
+
+        expression = parse_expression("x + (((((-z - -z) + (-x + 1.0)) - -(-y ^ (1 - y))) - y) + 1)")
+        variable_map = {b"x": 0.3, b"y": 0.7, b"z": 1.9}
+
+        self.assertAlmostEqual(
+            expression.simplify().compile()(variable_map),
+            expression.compile()(variable_map))
+
+    def test_deep_simplify(self):
+        # Deeper than the recursion limit
+        expression = self.x
+        for i in range(5000):
+            expression = (expression + self.y) * 1
+
+        simplified = expression.simplify(max_iters=3)
+        self.assertEqual(simplified.compile()({b"x": 1, b"y": 2}), 10001)
+
+
+if __name__ == "__main__":
+    unittest.main()
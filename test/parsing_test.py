@@ -0,0 +1,53 @@
+import unittest
+
+from expression import Variable, Constant, Wildcard, Sin, Neg
+from parsing import parse_expression, SyntaxError, ParseFailed
+
+
+class TestParsing(unittest.TestCase):
+
+    x = Variable("x")
+    y = Variable("y")
+
+    def test_precedence(self):
+        self.assertIs(parse_expression("x + y * x ^ 2"), self.x + self.y * self.x ** 2)
+        self.assertIs(parse_expression("x - y - x"), (self.x - self.y) - self.x)
+        self.assertIs(parse_expression("(x + y) * x"), (self.x + self.y) * self.x)
+        self.assertIs(parse_expression("sin(x)^2"), Sin(self.x) ** 2)
+        self.assertIs(parse_expression("#1 * x"), Wildcard(1) * self.x)
+
+    def test_prefix(self):
+        self.assertIs(parse_expression("-x^2"), Neg(self.x ** 2))
+        self.assertIs(parse_expression("x^-2 * y"), self.x ** -2 * self.y)
+        self.assertIs(parse_expression("x * -y"), self.x * Neg(self.y))
+        self.assertIs(parse_expression("+x"), self.x)
+
+        # A sign written against a number is part of it, when an operand is expected
+        self.assertIs(parse_expression("-2^2"), Constant(4))
+        self.assertIs(parse_expression("x^-2^2"), (self.x ** -2) ** 2)
+        self.assertIs(parse_expression("- 2^2"), Constant(-4))
+        self.assertIs(parse_expression("x-2^2"), self.x - 4)
+
+    def test_signs_without_spaces(self):
+        self.assertIs(parse_expression("x+1"), self.x + 1)
+        self.assertIs(parse_expression("x-1"), self.x - 1)
+        self.assertIs(parse_expression("-1"), parse_expression("- 1"))
+
+    def test_deep_parentheses(self):
+        # Deeper than the recursion limit
+        self.assertIs(parse_expression("(" * 5000 + "x" + ")" * 5000), self.x)
+
+    def test_errors(self):
+        for string in ["", "()", "x +", "x y", "(x", "x)", "* x", "sin()"]:
+            with self.assertRaises(SyntaxError):
+                parse_expression(string)
+
+        with self.assertRaises(ParseFailed):
+            parse_expression("unknown(x)")
+
+        with self.assertRaises(ParseFailed):
+            parse_expression("x $ y")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from fractions import Fraction
+
+import simplification_cache
+from expression import Expression, Variable
+from parsing import parse_expression
+from simplification_cache import SimplificationCache
+
+
+class TestSimplificationCache(unittest.TestCase):
+
+    test_expressions = [
+        parse_expression("x^2 * x^3"),
+        parse_expression("(x + 0) * 1 + y^1"),
+        parse_expression("exp(x) * exp(y) + log(x) + log(y)")
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_simplify(self):
+        cache = SimplificationCache(self.directory.name)
+        for expression in self.test_expressions:
+            self.assertIs(cache.simplify(expression), expression.simplify())
+
+        self.assertEqual(len(os.listdir(self.directory.name)), len(self.test_expressions))
+
+        # Results read back from disk, without simplifying again
+        expected = [expression.simplify() for expression in self.test_expressions]
+        cache = SimplificationCache(self.directory.name)
+        with mock.patch.object(Expression, "simplify", side_effect=AssertionError("Not read from disk")):
+            for expression, simplified in zip(self.test_expressions, expected):
+                self.assertIs(cache.simplify(expression), simplified)
+
+    def test_rules_changed(self):
+        cache = SimplificationCache(self.directory.name)
+        expression = self.test_expressions[0]
+        cache.simplify(expression)
+
+        # Entries made with other rules aren't used
+        with mock.patch.object(simplification_cache, "_key_salt", b"other rules"):
+            with mock.patch.object(Expression, "simplify", return_value=expression) as simplify:
+                self.assertIs(cache.simplify(expression), expression)
+                simplify.assert_called_once()
+
+    def test_max_entries(self):
+        cache = SimplificationCache(self.directory.name, max_entries=2)
+        for expression in self.test_expressions:
+            cache.simplify(expression)
+
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+    def test_not_encodable(self):
+        cache = SimplificationCache(self.directory.name)
+        # Fractions have no encoding
+        expression = Variable("x") * Fraction(1, 3) + 0
+        self.assertIs(cache.simplify(expression), expression.simplify())
+        self.assertEqual(len(os.listdir(self.directory.name)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import numpy as np
+import unittest
+from unittest import mock
+from hypothesis import given, strategies as st
+
+import symengine_backend
+from expression import Variable, Modulo, EvaluationError
+from parsing import parse_expression
+from symengine_backend import symengine, diff, simplify, function, to_symengine, from_symengine
+
+
+_test_expressions = [
+    parse_expression("x^2 + 1"),
+    parse_expression("x*y - y/x"),
+    parse_expression("exp(x) * log(y^2 + 1)"),
+    parse_expression("cos(x)^2 + sin(x)^2 - y")
+]
+
+
+class TestFallback(unittest.TestCase):
+    """ Without symengine, the functions here are the Expression methods"""
+
+    @mock.patch.object(symengine_backend, "symengine", None)
+    def test_fallback(self):
+        for expression in _test_expressions:
+            self.assertIs(diff(expression, Variable("x")), expression.diff(Variable("x")))
+            self.assertIs(simplify(expression), expression.simplify())
+
+            variables = {b"x": 2.0, b"y": 3.0}
+            self.assertEqual(function(expression)(variables), expression(variables))
+
+    @mock.patch.object(symengine_backend, "symengine", None)
+    def test_conversion_unavailable(self):
+        with self.assertRaises(EvaluationError):
+            to_symengine(_test_expressions[0])
+
+
+@unittest.skipIf(symengine is None, "symengine not installed")
+class TestSymEngineBackend(unittest.TestCase):
+
+    test_expressions = _test_expressions
+
+    @given(
+        x=st.floats(min_value=0.1, max_value=10),
+        y=st.floats(min_value=-10, max_value=10))
+
+    def test_round_trip(self, x: float, y: float):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            converted = from_symengine(*to_symengine(expression))
+
+            # Terms can be combined differently, so values that should be zero can differ by rounding
+            np.testing.assert_allclose(converted(variables), expression(variables), atol=1e-12)
+            np.testing.assert_allclose(simplify(expression)(variables), expression(variables), atol=1e-12)
+
+    @given(
+        x=st.floats(min_value=0.1, max_value=10),
+        y=st.floats(min_value=-10, max_value=10))
+
+    def test_diff(self, x: float, y: float):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            np.testing.assert_allclose(
+                diff(expression, Variable("x"))(variables),
+                expression.fast_diff(Variable("x"))(variables))
+
+    @given(
+        x=st.floats(min_value=0.1, max_value=10),
+        y=st.floats(min_value=-10, max_value=10))
+
+    def test_function(self, x: float, y: float):
+        variables = {b"x": x, b"y": y}
+        for expression in self.test_expressions:
+            np.testing.assert_allclose(function(expression)(variables), expression(variables))
+
+    def test_print_aliases(self):
+        # Variables with the same identity are one variable, whatever their print aliases
+        a = Variable("x", print_alias="a")
+        b = Variable("x", print_alias="b")
+
+        variables = {b"x": 3.0}
+        self.assertEqual(diff(a * b, Variable("x"))(variables), 6.0)
+        self.assertEqual(len(to_symengine(a * b)[1]), 1)
+
+    def test_modulo_unsupported(self):
+        with self.assertRaises(EvaluationError):
+            to_symengine(Modulo(Variable("x"), Variable("y")))
+
+
+if __name__ == "__main__":
+    unittest.main()